@@ -0,0 +1,328 @@
+import gzip
+import hashlib
+import json
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+import brotli
+import numpy as np
+from django.db import transaction
+
+from foodgram.cache import CacheNamespace, has_atomic_incr
+from recipes.models import Ingredient, RecipeIngredient
+
+
+logger = logging.getLogger(__name__)
+
+AUTOCOMPLETE_LIMIT = 50
+# Не чаще раза в столько секунд процесс сверяет своё поколение
+# каталогов с общим.
+GENERATION_CHECK_INTERVAL = 1
+# Если процесс отстал от журнала изменений рецептов больше, чем на
+# столько записей, индекс дешевле построить заново.
+RECIPE_INDEX_MAX_CHANGES = 1000
+RECIPE_INDEX_CHUNK_SIZE = 10_000
+
+cache = CacheNamespace('ingredients')
+recipe_index_cache = CacheNamespace('recipe_ingredients', timeout=60 * 60)
+
+
+class LazyCatalog:
+    """Производная от таблицы ингредиентов структура в памяти процесса.
+
+    Строится при первом обращении (или заранее через warm()).
+    Изменение данных в любом процессе повышает поколение в общем
+    кэше, и процессы со старым поколением строят структуру заново,
+    если _apply_changes() не смог обновить её на месте.
+    """
+
+    namespace = cache
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = None
+        self._generation = None
+        self._checked_at = 0
+
+    def _build(self):
+        raise NotImplementedError
+
+    def _apply_changes(self, old_generation, new_generation):
+        """Обновляет структуру до нового поколения, False — не удалось."""
+        return False
+
+    def _get_data(self):
+        if time.monotonic() - self._checked_at > GENERATION_CHECK_INTERVAL:
+            generation = self.namespace.generation()
+            self._checked_at = time.monotonic()
+            if generation != self._generation:
+                if not self._apply_changes(self._generation, generation):
+                    self._data = None
+                self._generation = generation
+        data = self._data
+        if data is not None:
+            return data
+        with self._lock:
+            if self._data is None:
+                self._data = self._build()
+            return self._data
+
+    def warm(self):
+        try:
+            self._get_data()
+        except Exception as ex:
+            logger.warning(f'{type(self).__name__} is not warmed: {ex}')
+
+    def invalidate(self):
+        self._data = None
+
+
+class IngredientIndex(LazyCatalog):
+    """Индекс ингредиентов для автодополнения.
+
+    Хранит отсортированный по названию в нижнем регистре список
+    ингредиентов: совпадения по началу строки находятся бинарным
+    поиском, совпадения по подстроке добавляются после них.
+    """
+
+    def _build(self):
+        items = sorted(
+            Ingredient.objects.values(
+                'id',
+                'name',
+                'measurement_unit',
+            ).iterator(),
+            key=lambda item: item['name'].lower(),
+        )
+        return [item['name'].lower() for item in items], items
+
+    def search(self, query, limit=AUTOCOMPLETE_LIMIT):
+        """Ингредиенты, название которых начинается с query или содержит его.
+
+        Совпадения по началу идут первыми, оба списка — по алфавиту.
+        """
+        keys, items = self._get_data()
+        query = query.lower()
+        result = []
+        index = bisect_left(keys, query)
+        while (
+            index < len(keys)
+            and len(result) < limit
+            and keys[index].startswith(query)
+        ):
+            result.append(items[index])
+            index += 1
+        if len(result) < limit:
+            for key, item in zip(keys, items):
+                if query in key and not key.startswith(query):
+                    result.append(item)
+                    if len(result) >= limit:
+                        break
+        return result
+
+
+class IngredientSnapshot(LazyCatalog):
+    """Готовый JSON всего каталога ингредиентов.
+
+    Хранит тело ответа без сжатия и в вариантах gzip и br, а также
+    версию — хэш содержимого, из которого строятся ETag.
+    """
+
+    encodings = ('br', 'gzip')
+
+    def _build(self):
+        content = json.dumps(
+            list(
+                Ingredient.objects.values(
+                    'id',
+                    'name',
+                    'measurement_unit',
+                ).iterator(),
+            ),
+            ensure_ascii=False,
+            separators=(',', ':'),
+        ).encode()
+        return {
+            'version': hashlib.sha256(content).hexdigest()[:32],
+            None: content,
+            'gzip': gzip.compress(content, compresslevel=9, mtime=0),
+            'br': brotli.compress(content, quality=11),
+        }
+
+    def get(self, accept_encoding=''):
+        """Версия каталога, кодировка и тело с учётом Accept-Encoding."""
+        data = self._get_data()
+        accepted = set()
+        for part in accept_encoding.lower().split(','):
+            encoding, _, params = part.partition(';')
+            if params.replace(' ', '').rstrip('0.') != 'q=':
+                accepted.add(encoding.strip())
+        for encoding in self.encodings:
+            if encoding in accepted:
+                return data['version'], encoding, data[encoding]
+        return data['version'], None, data[None]
+
+
+class RecipeIngredientIndex(LazyCatalog):
+    """Обратный индекс «ингредиент → рецепты» для подбора по продуктам.
+
+    Для каждого ингредиента хранит отсортированный массив id рецептов
+    с ним, для каждого рецепта — массив его ингредиентов, а число
+    ингредиентов рецепта — в плотном массиве по id рецепта. Изменение
+    рецепта записывается в общий кэш под номером нового поколения, и
+    процессы применяют эти записи к своему индексу; заново индекс
+    строится, только если записи потеряны или их слишком много.
+    Журнал ведётся, только если incr кэша атомарен: иначе два процесса
+    могут записать изменения под одним номером, и индекс при каждой
+    смене поколения строится заново.
+    """
+
+    namespace = recipe_index_cache
+
+    def _build(self):
+        data = {'postings': {}, 'recipes': {}, 'totals': array('H')}
+        rows = RecipeIngredient.objects.order_by(
+            'recipe_id',
+            'ingredient_id',
+        ).values_list('recipe_id', 'ingredient_id').distinct()
+        ingredients = defaultdict(list)
+        for recipe_id, ingredient_id in rows.iterator(
+            chunk_size=RECIPE_INDEX_CHUNK_SIZE,
+        ):
+            ingredients[recipe_id].append(ingredient_id)
+        postings = defaultdict(lambda: array('I'))
+        for recipe_id, ingredient_ids in ingredients.items():
+            # Рецепты идут по возрастанию id, массивы остаются
+            # отсортированными.
+            for ingredient_id in ingredient_ids:
+                postings[ingredient_id].append(recipe_id)
+            self._set_recipe(data, recipe_id, ingredient_ids)
+        data['postings'] = dict(postings)
+        return data
+
+    def _apply_changes(self, old_generation, new_generation):
+        data = self._data
+        if (
+            data is None
+            or old_generation is None
+            or not has_atomic_incr()
+            or not 0 < new_generation - old_generation
+            <= RECIPE_INDEX_MAX_CHANGES
+        ):
+            return False
+        changes = self.namespace.get_many(
+            f'changes:{generation}'
+            for generation in range(old_generation + 1, new_generation + 1)
+        )
+        if len(changes) != new_generation - old_generation:
+            return False
+        recipe_ids = set().union(*changes.values())
+        ingredients = defaultdict(set)
+        for recipe_id, ingredient_id in RecipeIngredient.objects.filter(
+            recipe_id__in=recipe_ids,
+        ).values_list('recipe_id', 'ingredient_id'):
+            ingredients[recipe_id].add(ingredient_id)
+        with self._lock:
+            for recipe_id in recipe_ids:
+                self._replace_recipe(
+                    data,
+                    recipe_id,
+                    sorted(ingredients[recipe_id]),
+                )
+        return True
+
+    def _set_recipe(self, data, recipe_id, ingredient_ids):
+        totals = data['totals']
+        if recipe_id >= len(totals):
+            totals.frombytes(
+                bytes(totals.itemsize * (recipe_id + 1 - len(totals))),
+            )
+        totals[recipe_id] = len(ingredient_ids)
+        if ingredient_ids:
+            data['recipes'][recipe_id] = array('I', ingredient_ids)
+        else:
+            data['recipes'].pop(recipe_id, None)
+
+    def _replace_recipe(self, data, recipe_id, ingredient_ids):
+        postings = data['postings']
+        for ingredient_id in data['recipes'].get(recipe_id, ()):
+            posting = postings[ingredient_id]
+            position = bisect_left(posting, recipe_id)
+            if position < len(posting) and posting[position] == recipe_id:
+                del posting[position]
+            if not posting:
+                del postings[ingredient_id]
+        for ingredient_id in ingredient_ids:
+            insort(postings.setdefault(ingredient_id, array('I')), recipe_id)
+        self._set_recipe(data, recipe_id, ingredient_ids)
+
+    def rank(self, ingredient_ids, limit):
+        """Рецепты с наибольшей долей ингредиентов из ingredient_ids.
+
+        Возвращает список (id рецепта, найдено ингредиентов, всего
+        ингредиентов) по убыванию доли, при равной доле — по числу
+        недостающих ингредиентов и от новых рецептов к старым.
+        """
+        data = self._get_data()
+        # Пока массивы открыты для NumPy, их нельзя изменять.
+        with self._lock:
+            return self._rank(data, set(ingredient_ids), limit)
+
+    @staticmethod
+    def _rank(data, ingredient_ids, limit):
+        postings = [
+            np.frombuffer(data['postings'][ingredient_id], dtype=np.uint32)
+            for ingredient_id in ingredient_ids
+            if ingredient_id in data['postings']
+        ]
+        if not postings or limit <= 0:
+            return []
+        recipe_ids, matched = np.unique(
+            np.concatenate(postings),
+            return_counts=True,
+        )
+        recipe_ids = recipe_ids.astype(np.int64)
+        totals = np.frombuffer(data['totals'], dtype=np.uint16)[recipe_ids]
+        totals = np.maximum(totals.astype(np.int64), matched)
+        coverage = matched / totals
+        if len(recipe_ids) > limit:
+            # Полная сортировка нужна только рецептам не хуже limit-го.
+            threshold = np.partition(coverage, -limit)[-limit]
+            selected = coverage >= threshold
+            recipe_ids = recipe_ids[selected]
+            matched = matched[selected]
+            totals = totals[selected]
+            coverage = coverage[selected]
+        order = np.lexsort((-recipe_ids, totals - matched, -coverage))
+        return [
+            (int(recipe_ids[i]), int(matched[i]), int(totals[i]))
+            for i in order[:limit]
+        ]
+
+
+ingredient_index = IngredientIndex()
+ingredient_snapshot = IngredientSnapshot()
+recipe_ingredient_index = RecipeIngredientIndex()
+
+
+def invalidate_ingredient_catalogs():
+    """Сбрасывает каталоги этого процесса и помечает устаревшими остальные."""
+    cache.bump()
+    ingredient_index.invalidate()
+    ingredient_snapshot.invalidate()
+
+
+def recipes_changed(recipe_ids):
+    """Записывает изменение ингредиентов рецептов после коммита."""
+    recipe_ids = set(recipe_ids)
+
+    def publish():
+        generation = recipe_index_cache.bump()
+        if has_atomic_incr():
+            recipe_index_cache.set(f'changes:{generation}', recipe_ids)
+
+    transaction.on_commit(publish)
@@ -0,0 +1,79 @@
+"""Валидаторы для условных GET-запросов к рецептам и подпискам.
+
+ETag строится из агрегатов по рецептам (число строк и наибольший
+updated_at) и из состояния пользователя, от которого зависят флаги
+в ответе: числа и наибольшие id его строк в избранном, корзине и
+подписках. Ответ 304 отдаётся до чтения и сериализации данных.
+"""
+
+import hashlib
+
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from recipes.models import Favorite, Follow, ShoppingCart, User
+
+
+# Повышается при изменении формата ответов, чтобы сбросить ETag клиентов.
+ETAG_VERSION = 1
+
+
+def make_etag(*parts):
+    return quote_etag(
+        hashlib.md5(
+            ':'.join(map(str, (ETAG_VERSION, *parts))).encode(),
+        ).hexdigest(),
+    )
+
+
+def row_stats(model):
+    rows = model.objects.filter(user=OuterRef('pk')).order_by().values('user')
+    return (
+        Subquery(rows.annotate(value=Count('id')).values('value')),
+        Subquery(rows.annotate(value=Max('id')).values('value')),
+    )
+
+
+def user_state(user, models=(Favorite, ShoppingCart, Follow)):
+    """Сводка избранного, корзины и подписок пользователя одним запросом."""
+    if not user.is_authenticated:
+        return None
+    annotations = {}
+    for model in models:
+        count, last_id = row_stats(model)
+        name = model.__name__.lower()
+        annotations[f'{name}_count'] = count
+        annotations[f'{name}_last_id'] = last_id
+    return User.objects.filter(pk=user.pk).annotate(
+        **annotations,
+    ).values_list(*annotations).first()
+
+
+def not_modified(request, etag, last_modified=None):
+    """Ответ 304 или None, если у клиента устаревшая копия.
+
+    Ответы пользователю зависят от его флагов, которые дата изменения
+    рецепта не отражает, поэтому для них сверяется только ETag.
+    """
+    if request.user.is_authenticated or last_modified is None:
+        timestamp = None
+    else:
+        timestamp = int(last_modified.timestamp())
+    return get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=timestamp,
+    )
+
+
+def set_validators(request, response, etag, last_modified=None):
+    response['ETag'] = etag
+    if request.user.is_authenticated:
+        response['Cache-Control'] = 'private, no-cache'
+    else:
+        response['Cache-Control'] = 'no-cache'
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified.timestamp())
+    patch_vary_headers(response, ('Authorization',))
+    return response
@@ -0,0 +1,46 @@
+import re
+
+from django.conf import settings
+from django.http import HttpResponseRedirect, JsonResponse
+
+from . import shortlinks
+
+
+SHORT_LINK_PATH = re.compile(r'^/a/r/(?P<code>[0-9A-Za-z_-]{1,10})/?$')
+
+ERRORS = {
+    'recipe_not_found': 'Рецепт не найден',
+}
+
+
+def short_link_response(code):
+    """Редирект на рецепт по короткому коду или ответ 404."""
+    recipe_id = shortlinks.resolve(code)
+    if recipe_id is None:
+        return JsonResponse(
+            {'detail': ERRORS['recipe_not_found']},
+            status=404,
+            json_dumps_params={'ensure_ascii': False},
+        )
+    return HttpResponseRedirect(
+        f'{settings.BASE_URL}/api/recipes/{recipe_id}',
+    )
+
+
+class ShortLinkRedirectMiddleware:
+    """Отвечает на короткие ссылки /a/r/<код>/ в начале цепочки.
+
+    Переходы по коротким ссылкам — самый частый публичный запрос,
+    поэтому сессии, аутентификация, CSRF и разрешение URL для них
+    не выполняются. Стоит первым в MIDDLEWARE.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.method in ('GET', 'HEAD'):
+            match = SHORT_LINK_PATH.match(request.path_info)
+            if match:
+                return short_link_response(match['code'])
+        return self.get_response(request)
@@ -0,0 +1,151 @@
+import base64
+import binascii
+import json
+from operator import attrgetter
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class KeysetPagination(LimitOffsetPagination):
+    """Пагинация limit/offset с включаемым курсорным режимом.
+
+    Без параметра cursor работает как LimitOffsetPagination. Параметр
+    cursor (пустой для первой страницы) включает постраничный проход по
+    ключу сортировки: страница выбирается условием по значениям ключа
+    граничной записи, поэтому её стоимость не зависит от глубины.
+    Ключ задаётся атрибутом cursor_ordering представления и должен
+    быть уникальным, например ('-created_at', '-id'). Если
+    представление уже посчитало записи, оно передаёт число в атрибуте
+    queryset_count, и отдельный COUNT не выполняется.
+    """
+
+    cursor_query_param = 'cursor'
+    cursor_ordering = ('-created_at', '-id')
+    invalid_cursor_message = 'Некорректный курсор.'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.view = view
+        if self.cursor_query_param not in request.query_params:
+            self.cursor_mode = False
+            return super().paginate_queryset(queryset, request, view)
+        self.cursor_mode = True
+        self.request = request
+        self.limit = self.get_limit(request) or self.default_limit
+        self.ordering = getattr(view, 'cursor_ordering', self.cursor_ordering)
+        values, reverse = self.decode_cursor(request)
+        ordering = self.ordering
+        if reverse:
+            ordering = tuple(self.invert(field) for field in ordering)
+        queryset = queryset.order_by(*ordering)
+        try:
+            # Значения курсора проверяются полями при построении условия.
+            if values is not None:
+                queryset = queryset.filter(self.after(ordering, values))
+            page = list(queryset[:self.limit + 1])
+        except (ValidationError, ValueError, TypeError):
+            raise NotFound(self.invalid_cursor_message)
+        has_more = len(page) > self.limit
+        page = page[:self.limit]
+        if reverse:
+            page.reverse()
+            self.has_next = values is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = values is not None
+        self.page = page
+        return page
+
+    def get_count(self, queryset):
+        count = getattr(self.view, 'queryset_count', None)
+        if count is None:
+            return super().get_count(queryset)
+        return count
+
+    def get_paginated_response(self, data):
+        if not self.cursor_mode:
+            return super().get_paginated_response(data)
+        return Response({
+            'count': None,
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_next_link(self):
+        if not self.cursor_mode:
+            return super().get_next_link()
+        if not self.has_next or not self.page:
+            return None
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not self.cursor_mode:
+            return super().get_previous_link()
+        if not self.has_previous or not self.page:
+            return None
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def encode_cursor(self, instance, reverse):
+        values = [
+            self.dump_value(attrgetter(field.lstrip('-'))(instance))
+            for field in self.ordering
+        ]
+        cursor = base64.urlsafe_b64encode(
+            json.dumps({'v': values, 'r': reverse}).encode(),
+        ).decode()
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.offset_query_param)
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            values = cursor['v']
+            reverse = bool(cursor['r'])
+        except (binascii.Error, ValueError, TypeError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        if (
+            not isinstance(values, list)
+            or len(values) != len(self.ordering)
+            or not all(
+                isinstance(value, (str, int, float))
+                and not isinstance(value, bool)
+                for value in values
+            )
+        ):
+            raise NotFound(self.invalid_cursor_message)
+        return values, reverse
+
+    @staticmethod
+    def dump_value(value):
+        if hasattr(value, 'isoformat'):
+            return value.isoformat()
+        return value
+
+    @staticmethod
+    def invert(field):
+        return field[1:] if field.startswith('-') else f'-{field}'
+
+    @staticmethod
+    def after(ordering, values):
+        """Условие «строго после записи со значениями values» для ordering.
+
+        Для ключа (a, b) по убыванию: a < va OR (a = va AND b < vb).
+        """
+        condition = Q()
+        equal = {}
+        for field, value in zip(ordering, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+        return condition
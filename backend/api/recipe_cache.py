@@ -0,0 +1,68 @@
+"""Кэш представления рецепта для страницы рецепта.
+
+Хранится представление, каким его видит анонимный пользователь:
+флаги is_favorited, is_in_shopping_cart и author.is_subscribed
+в нём ложны и подставляются для пользователя при каждом запросе.
+Под ключом рецепта лежит словарь вариантов: URL изображений зависят
+от хоста запроса и параметра images. Записи удаляются сигналами при
+изменении рецепта, его ингредиентов и автора.
+"""
+
+from django.db import transaction
+
+from .serializers import IMAGES_PARAM
+from foodgram.cache import CacheNamespace
+
+
+RECIPE_FLAGS = ('is_favorited', 'is_in_shopping_cart')
+AUTHOR_FLAGS = ('is_subscribed',)
+
+cache = CacheNamespace('recipes', timeout=24 * 60 * 60, version=2)
+
+
+def variant(request):
+    return (
+        f'{request.scheme}://{request.get_host()}'
+        f'|{request.query_params.get(IMAGES_PARAM, "")}'
+    )
+
+
+def get(recipe_id, request):
+    """Пара (updated_at, представление) из кэша или None."""
+    return (cache.get(recipe_id) or {}).get(variant(request))
+
+
+def store(recipe_id, request, updated_at, data):
+    """Сохраняет представление рецепта без флагов пользователя."""
+    data = dict(data)
+    data.update(dict.fromkeys(RECIPE_FLAGS, False))
+    data['author'] = dict(data['author'])
+    data['author'].update(dict.fromkeys(AUTHOR_FLAGS, False))
+    variants = cache.get(recipe_id) or {}
+    variants[variant(request)] = updated_at, data
+    cache.set(recipe_id, variants)
+    return updated_at, data
+
+
+def with_flags(data, is_favorited, is_in_shopping_cart, is_subscribed):
+    """Копия представления с флагами пользователя."""
+    data = dict(
+        data,
+        is_favorited=is_favorited,
+        is_in_shopping_cart=is_in_shopping_cart,
+    )
+    data['author'] = dict(data['author'], is_subscribed=is_subscribed)
+    return data
+
+
+def invalidate(recipe_ids):
+    """Удаляет записи сразу и ещё раз после коммита транзакции.
+
+    Повторное удаление убирает запись, которую мог сохранить другой
+    запрос, прочитавший рецепт до коммита изменений.
+    """
+    recipe_ids = list(recipe_ids)
+    if not recipe_ids:
+        return
+    cache.delete_many(recipe_ids)
+    transaction.on_commit(lambda: cache.delete_many(recipe_ids))
@@ -0,0 +1,62 @@
+import csv
+import json
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+
+SHOPPING_LIST_TITLE = 'Список покупок'
+SHOPPING_LIST_HEADER = ('Ингредиенты', 'Количество', 'Единицы измерения')
+SHOPPING_LIST_FIELDS = ('name', 'amount', 'measurement_unit')
+
+
+class Echo:
+    """Псевдобуфер для csv.writer: возвращает строку вместо записи."""
+
+    def write(self, value):
+        return value
+
+
+class ShoppingListCSVRenderer(BaseRenderer):
+    """Список покупок в CSV.
+
+    stream() отдаёт документ построчно для StreamingHttpResponse,
+    render() нужен только для ответов с ошибками.
+    """
+
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+    delimiter = ','
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, dict):
+            data = data.items()
+        elif not isinstance(data, (list, tuple)):
+            data = [[data]]
+        writer = csv.writer(Echo(), delimiter=self.delimiter)
+        return ''.join(writer.writerow(row) for row in data).encode()
+
+    def stream(self, rows):
+        writer = csv.writer(Echo(), delimiter=self.delimiter)
+        yield writer.writerow([SHOPPING_LIST_TITLE])
+        yield writer.writerow(SHOPPING_LIST_HEADER)
+        for row in rows:
+            yield writer.writerow(row)
+
+
+class ShoppingListTSVRenderer(ShoppingListCSVRenderer):
+    media_type = 'text/tab-separated-values'
+    format = 'tsv'
+    delimiter = '\t'
+
+
+class ShoppingListJSONRenderer(JSONRenderer):
+    def stream(self, rows):
+        yield '['
+        for index, row in enumerate(rows):
+            item = json.dumps(
+                dict(zip(SHOPPING_LIST_FIELDS, row)),
+                ensure_ascii=False,
+            )
+            yield item if not index else f',{item}'
+        yield ']'
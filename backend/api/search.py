@@ -0,0 +1,84 @@
+"""Полнотекстовый поиск рецептов.
+
+В PostgreSQL поиск идёт по хранимому полю Recipe.search_vector с
+GIN-индексом: название (вес A), названия ингредиентов (B) и описание
+(C) со стеммингом русского языка, результаты ранжируются SearchRank.
+Поле пересчитывается после коммита транзакции, изменившей рецепт или
+его ингредиенты. В других СУБД каждое слово запроса ищется по
+подстроке без ранжирования (SQLite не различает регистр только у
+латиницы).
+"""
+
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import (
+    SearchQuery,
+    SearchRank,
+    SearchVector,
+)
+from django.db import connection, transaction
+from django.db.models import Exists, F, OuterRef, Q, Subquery
+
+from recipes.models import Recipe, RecipeIngredient
+
+
+SEARCH_CONFIG = 'russian'
+RANK_ORDERING = ('-search_rank', '-id')
+
+
+def is_ranked():
+    """Поддерживает ли база полнотекстовый поиск с ранжированием."""
+    return connection.vendor == 'postgresql'
+
+
+def search_vector():
+    ingredient_names = Subquery(
+        RecipeIngredient.objects.filter(recipe=OuterRef('pk'))
+        .order_by()
+        .values('recipe')
+        .annotate(names=StringAgg('ingredient__name', ' '))
+        .values('names'),
+    )
+    return (
+        SearchVector('name', weight='A', config=SEARCH_CONFIG)
+        + SearchVector(ingredient_names, weight='B', config=SEARCH_CONFIG)
+        + SearchVector('text', weight='C', config=SEARCH_CONFIG)
+    )
+
+
+def update_search_vectors(recipe_ids):
+    if is_ranked():
+        Recipe.objects.filter(id__in=recipe_ids).update(
+            search_vector=search_vector(),
+        )
+
+
+def schedule_search_vectors(recipe_ids):
+    """Пересчитывает поисковые поля рецептов после коммита транзакции."""
+    if is_ranked():
+        recipe_ids = list(recipe_ids)
+        transaction.on_commit(lambda: update_search_vectors(recipe_ids))
+
+
+def search_recipes(queryset, query):
+    """Рецепты, подходящие под запрос, с рангом в search_rank."""
+    if is_ranked():
+        query = SearchQuery(
+            query,
+            config=SEARCH_CONFIG,
+            search_type='websearch',
+        )
+        return queryset.filter(search_vector=query).annotate(
+            search_rank=SearchRank(F('search_vector'), query),
+        )
+    for word in query.split():
+        queryset = queryset.filter(
+            Q(name__icontains=word)
+            | Q(text__icontains=word)
+            | Exists(
+                RecipeIngredient.objects.filter(
+                    recipe=OuterRef('pk'),
+                    ingredient__name__icontains=word,
+                ),
+            ),
+        )
+    return queryset
@@ -1,10 +1,16 @@
-import base64
 import binascii
+import logging
+from collections import Counter
+from operator import attrgetter
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.files.base import ContentFile
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.files.storage import default_storage
+from django.db import transaction
 from rest_framework import serializers, status
 
+from foodgram.images import check_image, decode_base64
 from recipes.models import (
     Favorite,
     Follow,
@@ -12,26 +18,82 @@ from recipes.models import (
     Recipe,
     RecipeIngredient,
     ShoppingCart,
+    ShoppingListItem,
 )
 
 
 User = get_user_model()
 
+logger = logging.getLogger(__name__)
+
 ALLOWED_IMAGE_FORMATS = ['jpeg', 'jpg', 'png', 'gif']
+IMAGES_PARAM = 'images'
+IMAGES_RENDITIONS = 'renditions'
 
 ERROR_MESSAGES = {
     'invalid_base64': 'Некорректный формат base64-изображения.',
     'invalid_image_format': 'Неподдерживаемый формат изображения.',
     'invalid_base64_data': 'Некорректные base64-данные.',
-    'ingredient_not_found': 'Ингредиент с указанным id не существует.',
+    'ingredients_not_found': 'Ингредиенты с id {ids} не существуют.',
     'ingredient_duplicate': 'Ингредиенты не могут повторяться.',
     'no_ingredients': 'Укажите хотя бы один ингредиент.',
     'empty_ingredients': 'Список ингредиентов не может быть пустым.',
 }
 
 
+def get_followed_author_ids(request):
+    """Id авторов, на которых подписан пользователь запроса.
+
+    Загружается одним запросом и кэшируется на объекте запроса, чтобы
+    вложенные сериализаторы пользователей не обращались к Follow
+    для каждой строки.
+    """
+    if not hasattr(request, '_followed_author_ids'):
+        request._followed_author_ids = set(
+            Follow.objects.filter(user=request.user).values_list(
+                'author_id',
+                flat=True,
+            ),
+        )
+    return request._followed_author_ids
+
+
 class Base64ImageField(serializers.ImageField):
-    """Поле для кодирования/декодирования base64-изображения."""
+    """Поле для кодирования/декодирования base64-изображения.
+
+    По умолчанию отдаёт абсолютный URL оригинала. Если задано
+    renditions_field и в запросе передан ?images=renditions, отдаёт
+    словарь с URL уменьшенных копий, размерами оригинала и blurhash;
+    пока копии не построены, все URL ведут на оригинал.
+    """
+
+    def __init__(self, *args, renditions_field=None, **kwargs):
+        self.renditions_field = renditions_field
+        super().__init__(*args, **kwargs)
+
+    def to_representation(self, value):
+        url = super().to_representation(value)
+        request = self.context.get('request')
+        if (
+            url is None
+            or self.renditions_field is None
+            or request is None
+            or request.query_params.get(IMAGES_PARAM) != IMAGES_RENDITIONS
+        ):
+            return url
+        renditions = getattr(value.instance, self.renditions_field) or {}
+        if renditions.get('source') != value.name:
+            renditions = {}
+        result = {}
+        for name in settings.IMAGE_RENDITIONS:
+            path = renditions.get(name)
+            result[name] = (
+                request.build_absolute_uri(default_storage.url(path))
+                if path else url
+            )
+        for key in ('width', 'height', 'blurhash'):
+            result[key] = renditions.get(key)
+        return result
 
     def to_internal_value(self, data):
         try:
@@ -49,13 +111,17 @@ class Base64ImageField(serializers.ImageField):
                         ERROR_MESSAGES['invalid_image_format'],
                     )
                 try:
-                    decoded_file = base64.b64decode(imgstr)
-                except (TypeError, binascii.Error):
+                    data = decode_base64(imgstr, name=f'photo.{ext}')
+                except (TypeError, ValueError, binascii.Error):
                     raise serializers.ValidationError(
                         ERROR_MESSAGES['invalid_base64_data'],
                     )
-                data = ContentFile(decoded_file, name=f'photo.{ext}')
+                check_image(data)
             return super().to_internal_value(data)
+        except serializers.ValidationError:
+            raise
+        except DjangoValidationError as ex:
+            raise serializers.ValidationError(ex.messages)
         except Exception as ex:
             raise serializers.ValidationError(str(ex))
 
@@ -80,7 +146,10 @@ class RecipeIngredientSerializer(serializers.ModelSerializer):
 
 class UserSerializer(serializers.ModelSerializer):
     is_subscribed = serializers.SerializerMethodField()
-    avatar = Base64ImageField(required=False)
+    avatar = Base64ImageField(
+        required=False,
+        renditions_field='avatar_renditions',
+    )
 
     class Meta:
         model = User
@@ -95,23 +164,59 @@ class UserSerializer(serializers.ModelSerializer):
         )
 
     def get_is_subscribed(self, obj):
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
         request = self.context.get('request')
         if not request or not request.user.is_authenticated:
             return False
-        return Follow.objects.filter(user=request.user, author=obj).exists()
+        return obj.id in get_followed_author_ids(request)
 
 
 class ShortRecipeSerializer(serializers.ModelSerializer):
     """Короткий сериализатор для рецептов из подписок."""
 
+    image = Base64ImageField(
+        read_only=True,
+        renditions_field='image_renditions',
+    )
+
     class Meta:
         model = Recipe
         fields = ('id', 'name', 'image', 'cooking_time')
 
 
+class CookableRecipeSerializer(ShortRecipeSerializer):
+    """Рецепт из подбора по ингредиентам в наличии.
+
+    coverage — доля ингредиентов рецепта, которые есть в наличии,
+    missing — недостающие ингредиенты с количеством.
+    """
+
+    coverage = serializers.FloatField(read_only=True)
+    matched_count = serializers.IntegerField(read_only=True)
+    missing = serializers.SerializerMethodField()
+
+    class Meta(ShortRecipeSerializer.Meta):
+        fields = ShortRecipeSerializer.Meta.fields + (
+            'coverage',
+            'matched_count',
+            'missing',
+        )
+
+    def get_missing(self, obj):
+        available = self.context['available']
+        return RecipeIngredientSerializer(
+            [
+                item
+                for item in obj.ingredients_items.all()
+                if item.ingredient_id not in available
+            ],
+            many=True,
+        ).data
+
+
 class FollowSerializer(UserSerializer):
     recipes = serializers.SerializerMethodField()
-    recipes_count = serializers.SerializerMethodField()
 
     class Meta:
         model = User
@@ -139,26 +244,14 @@ class FollowSerializer(UserSerializer):
             context=self.context,
         ).data
 
-    def get_recipes_count(self, obj):
-        return obj.recipes.count()
-
 
 class RecipeIngredientCreateSerializer(serializers.Serializer):
     id = serializers.IntegerField()
     amount = serializers.IntegerField(min_value=1)
 
-    def validate_id(self, value):
-        try:
-            Ingredient.objects.get(id=value)
-        except Ingredient.DoesNotExist:
-            raise serializers.ValidationError(
-                ERROR_MESSAGES['ingredient_not_found'],
-            )
-        return value
-
 
 class RecipeSerializer(serializers.ModelSerializer):
-    image = Base64ImageField()
+    image = Base64ImageField(renditions_field='image_renditions')
     author = UserSerializer(read_only=True)
     ingredients = RecipeIngredientCreateSerializer(many=True, write_only=True)
     cooking_time = serializers.IntegerField(min_value=1)
@@ -205,15 +298,30 @@ class RecipeSerializer(serializers.ModelSerializer):
                     'Ингредиенты не могут повторяться.',
                 )
             ingredient_ids.append(ingredient['id'])
+        ingredients = Ingredient.objects.in_bulk(ingredient_ids)
+        missing_ids = [
+            ingredient_id
+            for ingredient_id in ingredient_ids
+            if ingredient_id not in ingredients
+        ]
+        if missing_ids:
+            raise serializers.ValidationError(
+                ERROR_MESSAGES['ingredients_not_found'].format(
+                    ids=', '.join(map(str, missing_ids)),
+                ),
+            )
+        for ingredient in value:
+            ingredient['ingredient'] = ingredients[ingredient['id']]
         return value
 
+    @transaction.atomic
     def create(self, validated_data):
         ingredients_data = validated_data.pop('ingredients')
         recipe = Recipe.objects.create(**validated_data)
         recipe_ingredients = [
             RecipeIngredient(
                 recipe=recipe,
-                ingredient=Ingredient.objects.get(id=ingredient_data['id']),
+                ingredient=ingredient_data['ingredient'],
                 amount=ingredient_data['amount'],
             )
             for ingredient_data in ingredients_data
@@ -221,6 +329,7 @@ class RecipeSerializer(serializers.ModelSerializer):
         RecipeIngredient.objects.bulk_create(recipe_ingredients)
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         ingredients_data = validated_data.pop('ingredients', None)
         instance.name = validated_data.get('name', instance.name)
@@ -233,35 +342,96 @@ class RecipeSerializer(serializers.ModelSerializer):
             instance.image = validated_data.get('image', instance.image)
         instance.save()
         if ingredients_data is not None:
-            instance.ingredients_items.all().delete()
-            recipe_ingredients = [
-                RecipeIngredient(
-                    recipe=instance,
-                    ingredient=Ingredient.objects.get(
-                        id=ingredient_data['id'],
+            self.update_ingredients(instance, ingredients_data)
+        return instance
+
+    def update_ingredients(self, instance, ingredients_data):
+        """Приводит строки ингредиентов рецепта к ingredients_data.
+
+        Пишутся только изменившиеся строки: новые создаются, лишние
+        удаляются, у остальных обновляется количество. Повторные строки
+        одного ингредиента, оставшиеся от старых версий API, удаляются.
+        Удаление строк переносится в списки покупок сигналами, созданные
+        и изменённые пачкой строки — здесь.
+        """
+        existing = {}
+        duplicates = []
+        for item in sorted(
+            instance.ingredients_items.all(),
+            key=attrgetter('id'),
+        ):
+            if item.ingredient_id in existing:
+                duplicates.append(item.id)
+            else:
+                existing[item.ingredient_id] = item
+        new_amounts = {
+            ingredient_data['id']: ingredient_data['amount']
+            for ingredient_data in ingredients_data
+        }
+        to_create = []
+        to_update = []
+        deltas = Counter()
+        for ingredient_data in ingredients_data:
+            amount = ingredient_data['amount']
+            item = existing.get(ingredient_data['id'])
+            if item is None:
+                to_create.append(
+                    RecipeIngredient(
+                        recipe=instance,
+                        ingredient=ingredient_data['ingredient'],
+                        amount=amount,
                     ),
-                    amount=ingredient_data['amount'],
                 )
-                for ingredient_data in ingredients_data
-            ]
-            RecipeIngredient.objects.bulk_create(recipe_ingredients)
-        return instance
+                deltas[ingredient_data['id']] += amount
+            elif item.amount != amount:
+                deltas[item.ingredient_id] += amount - item.amount
+                item.amount = amount
+                to_update.append(item)
+        to_delete = duplicates + [
+            item.id
+            for ingredient_id, item in existing.items()
+            if ingredient_id not in new_amounts
+        ]
+        if to_delete:
+            RecipeIngredient.objects.filter(id__in=to_delete).delete()
+        if to_update:
+            RecipeIngredient.objects.bulk_update(to_update, ['amount'])
+        if to_create:
+            RecipeIngredient.objects.bulk_create(to_create)
+        logger.info(
+            f'Recipe {instance.id} ingredients: created {len(to_create)}, '
+            f'updated {len(to_update)}, deleted {len(to_delete)}.'
+        )
+        ShoppingListItem.objects.update_recipe(instance, deltas)
 
     def to_representation(self, instance):
         representation = super().to_representation(instance)
+        ingredients_items = instance.ingredients_items.all()
+        if 'ingredients_items' not in getattr(
+            instance,
+            '_prefetched_objects_cache',
+            {},
+        ):
+            ingredients_items = ingredients_items.select_related('ingredient')
         representation['ingredients'] = RecipeIngredientSerializer(
-            instance.ingredients_items.all(),
+            ingredients_items,
             many=True,
         ).data
         return representation
 
     def get_is_favorited(self, obj):
+        """Флаг из аннотации queryset, запрос — только для голого объекта."""
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
         request = self.context.get('request')
         if not request or not request.user.is_authenticated:
             return False
         return Favorite.objects.filter(user=request.user, recipe=obj).exists()
 
     def get_is_in_shopping_cart(self, obj):
+        """Флаг из аннотации queryset, запрос — только для голого объекта."""
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
         request = self.context.get('request')
         if not request or not request.user.is_authenticated:
             return False
@@ -272,7 +442,7 @@ class RecipeSerializer(serializers.ModelSerializer):
 
 
 class AddFavorite(serializers.ModelSerializer):
-    image = Base64ImageField()
+    image = Base64ImageField(renditions_field='image_renditions')
 
     class Meta:
         model = Recipe
@@ -280,7 +450,10 @@ class AddFavorite(serializers.ModelSerializer):
 
 
 class AddAvatar(serializers.ModelSerializer):
-    avatar = Base64ImageField(required=True)
+    avatar = Base64ImageField(
+        required=True,
+        renditions_field='avatar_renditions',
+    )
 
     class Meta:
         model = User
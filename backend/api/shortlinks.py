@@ -0,0 +1,88 @@
+"""Короткие коды ссылок на рецепты.
+
+Код — это id рецепта, переставленный биекцией на [0, 62**7) и
+записанный в base62 семью символами. Код вычисляется и разбирается
+без обращения к базе, разные рецепты не могут получить один код, а
+с восьмисимвольными хэшами старых ссылок коды не пересекаются по длине.
+"""
+
+import logging
+
+from foodgram.cache import CacheNamespace
+from recipes.models import Recipe, RecipeShortLink
+
+
+logger = logging.getLogger(__name__)
+
+
+ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+CODE_LENGTH = 7
+SPACE = len(ALPHABET) ** CODE_LENGTH
+# Множитель взаимно прост с SPACE, поэтому умножение по модулю
+# обратимо, а соседние id дают непохожие коды.
+MULTIPLIER = 2654435761
+OFFSET = 1580030173
+INVERSE = pow(MULTIPLIER, -1, SPACE)
+INDEX = {char: index for index, char in enumerate(ALPHABET)}
+
+cache = CacheNamespace(
+    'short_links',
+    timeout=30 * 24 * 60 * 60,
+    outcomes=('not_found',),
+)
+
+
+def encode(recipe_id):
+    """Короткий код для id рецепта."""
+    number = (recipe_id * MULTIPLIER + OFFSET) % SPACE
+    chars = []
+    for _ in range(CODE_LENGTH):
+        number, index = divmod(number, len(ALPHABET))
+        chars.append(ALPHABET[index])
+    return ''.join(reversed(chars))
+
+
+def decode(code):
+    """Id рецепта по коду или None, если код не из этой схемы."""
+    if len(code) != CODE_LENGTH:
+        return None
+    number = 0
+    for char in code:
+        if char not in INDEX:
+            return None
+        number = number * len(ALPHABET) + INDEX[char]
+    return (number - OFFSET) * INVERSE % SPACE
+
+
+def warm(code, recipe_id):
+    cache.set(code, recipe_id)
+
+
+def forget(codes):
+    cache.delete_many(codes)
+
+
+def resolve(code):
+    """Id рецепта по короткому коду или None.
+
+    Сначала смотрит кэш, затем делает один запрос по индексу:
+    для кода новой схемы проверяет, что рецепт с id из кода
+    существует, для старого хэша читает recipe_id ссылки.
+    """
+    recipe_id = cache.get(code)
+    if recipe_id is not None:
+        return recipe_id
+    recipe_id = decode(code)
+    if recipe_id is not None:
+        if not Recipe.objects.filter(pk=recipe_id).exists():
+            recipe_id = None
+    else:
+        recipe_id = RecipeShortLink.objects.filter(
+            url_hash=code,
+        ).values_list('recipe_id', flat=True).first()
+    if recipe_id is None:
+        cache.record('not_found')
+        logger.debug(f'Short link {code} not found')
+        return None
+    cache.set(code, recipe_id)
+    return recipe_id
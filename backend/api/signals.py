@@ -0,0 +1,204 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import recipe_cache, shortlinks
+from .catalog import invalidate_ingredient_catalogs, recipes_changed
+from .search import schedule_search_vectors
+from foodgram.images import renditions_built, schedule_renditions
+from recipes.models import (
+    Favorite,
+    Follow,
+    Ingredient,
+    Recipe,
+    RecipeIngredient,
+    RecipeShortLink,
+    ShoppingCart,
+    ShoppingListItem,
+    User,
+)
+
+
+# Модель строки: (модель со счётчиком, поле ссылки, счётчик).
+COUNTERS = {
+    Recipe: (User, 'author_id', 'recipes_count'),
+    Favorite: (Recipe, 'recipe_id', 'favorites_count'),
+    ShoppingCart: (Recipe, 'recipe_id', 'shopping_cart_count'),
+    Follow: (User, 'author_id', 'followers_count'),
+}
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def ingredient_changed(**kwargs):
+    invalidate_ingredient_catalogs()
+
+
+@receiver(post_save, sender=Ingredient)
+def ingredient_recipes_changed(instance, **kwargs):
+    # При удалении ингредиента сигналы отправят удалённые строки
+    # RecipeIngredient.
+    recipe_ids = list(
+        RecipeIngredient.objects.filter(ingredient=instance).values_list(
+            'recipe_id',
+            flat=True,
+        ).distinct(),
+    )
+    touch_recipes(recipe_ids)
+    schedule_search_vectors(recipe_ids)
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+def recipe_changed(instance, **kwargs):
+    recipe_cache.invalidate([instance.pk])
+    # Строки ингредиентов пишутся bulk_create без сигналов, но в той
+    # же транзакции, что и рецепт.
+    recipes_changed([instance.pk])
+
+
+@receiver(post_save, sender=RecipeIngredient)
+@receiver(post_delete, sender=RecipeIngredient)
+def recipe_ingredient_changed(instance, **kwargs):
+    touch_recipes([instance.recipe_id])
+    schedule_search_vectors([instance.recipe_id])
+    recipes_changed([instance.recipe_id])
+
+
+@receiver(post_save, sender=User)
+def author_changed(instance, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= {'last_login'}:
+        return
+    touch_author_recipes(instance.pk)
+
+
+@receiver(renditions_built, sender=Recipe)
+def recipe_renditions_built(pk, **kwargs):
+    touch_recipes([pk])
+
+
+@receiver(renditions_built, sender=User)
+def avatar_renditions_built(pk, **kwargs):
+    touch_author_recipes(pk)
+
+
+def touch_author_recipes(author_id):
+    touch_recipes(
+        Recipe.objects.filter(author_id=author_id).values_list(
+            'id',
+            flat=True,
+        ),
+    )
+
+
+def touch_recipes(recipe_ids):
+    """Отмечает изменение рецептов, которое не прошло через save().
+
+    Обновляет updated_at, от которого зависят ETag и Last-Modified,
+    и удаляет представления рецептов из кэша.
+    """
+    recipe_ids = list(recipe_ids)
+    Recipe.objects.filter(id__in=recipe_ids).update(updated_at=timezone.now())
+    recipe_cache.invalidate(recipe_ids)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_search_vector(instance, **kwargs):
+    # Вектор строится после коммита, когда записаны и ингредиенты.
+    schedule_search_vectors([instance.pk])
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_image_renditions(instance, **kwargs):
+    schedule_renditions(instance, 'image', 'image_renditions')
+
+
+@receiver(post_save, sender=User)
+def user_avatar_renditions(instance, **kwargs):
+    schedule_renditions(instance, 'avatar', 'avatar_renditions')
+
+
+@receiver(post_delete, sender=Recipe)
+def forget_recipe_short_code(instance, **kwargs):
+    shortlinks.forget([shortlinks.encode(instance.pk)])
+
+
+@receiver(post_delete, sender=RecipeShortLink)
+def forget_short_link(instance, **kwargs):
+    shortlinks.forget([instance.url_hash])
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_save, sender=Favorite)
+@receiver(post_save, sender=ShoppingCart)
+@receiver(post_save, sender=Follow)
+def counted_row_saved(sender, instance, created, **kwargs):
+    if created:
+        update_counter(sender, instance, 1)
+
+
+@receiver(post_delete, sender=Recipe)
+@receiver(post_delete, sender=Favorite)
+@receiver(post_delete, sender=ShoppingCart)
+@receiver(post_delete, sender=Follow)
+def counted_row_deleted(sender, instance, **kwargs):
+    # Срабатывает и при каскадном удалении, например вместе с
+    # пользователем.
+    update_counter(sender, instance, -1)
+
+
+def update_counter(sender, instance, delta):
+    model, field, counter = COUNTERS[sender]
+    model.increment(getattr(instance, field), counter, delta)
+
+
+# Списки покупок ведутся как сумма корзин: каждое событие применяет
+# свою разницу к корзинам, которые существуют в этот момент, поэтому
+# итог не зависит от порядка каскадного удаления.
+@receiver(post_save, sender=ShoppingCart)
+def cart_row_saved(instance, created, **kwargs):
+    if created:
+        ShoppingListItem.objects.add_recipe(
+            [instance.user_id],
+            instance.recipe_id,
+        )
+
+
+@receiver(post_delete, sender=ShoppingCart)
+def cart_row_deleted(instance, **kwargs):
+    ShoppingListItem.objects.remove_recipe(
+        [instance.user_id],
+        instance.recipe_id,
+    )
+
+
+@receiver(pre_save, sender=RecipeIngredient)
+def remember_recipe_ingredient(instance, **kwargs):
+    # Прежние значения строки нужны, чтобы вычесть их из списков.
+    instance.saved_row = None
+    if not instance._state.adding:
+        instance.saved_row = RecipeIngredient.objects.filter(
+            pk=instance.pk,
+        ).values_list('recipe_id', 'ingredient_id', 'amount').first()
+
+
+@receiver(post_save, sender=RecipeIngredient)
+def recipe_ingredient_saved(instance, **kwargs):
+    if instance.saved_row is not None:
+        recipe_id, ingredient_id, amount = instance.saved_row
+        ShoppingListItem.objects.update_recipe(
+            recipe_id,
+            {ingredient_id: -amount},
+        )
+    ShoppingListItem.objects.update_recipe(
+        instance.recipe_id,
+        {instance.ingredient_id: instance.amount},
+    )
+
+
+@receiver(post_delete, sender=RecipeIngredient)
+def recipe_ingredient_deleted(instance, **kwargs):
+    ShoppingListItem.objects.update_recipe(
+        instance.recipe_id,
+        {instance.ingredient_id: -instance.amount},
+    )
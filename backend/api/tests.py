@@ -1 +1,323 @@
-# Create your tests here.
+import base64
+import json
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from api import catalog
+
+from recipes.models import (
+    Favorite,
+    Follow,
+    Ingredient,
+    Recipe,
+    RecipeIngredient,
+    ShoppingCart,
+    ShoppingListItem,
+)
+from users.models import User
+
+
+class RecipeListQueryCountTest(TestCase):
+    """Число запросов к БД не зависит от размера страницы рецептов."""
+
+    INGREDIENTS_PER_RECIPE = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create(
+            username='author',
+            email='author@example.com',
+            first_name='Автор',
+            last_name='Рецептов',
+        )
+        cls.reader = User.objects.create(
+            username='reader',
+            email='reader@example.com',
+            first_name='Читатель',
+            last_name='Рецептов',
+        )
+        ingredients = Ingredient.objects.bulk_create(
+            Ingredient(name=f'ингредиент {i}', measurement_unit='г')
+            for i in range(cls.INGREDIENTS_PER_RECIPE)
+        )
+        recipes = Recipe.objects.bulk_create(
+            Recipe(
+                name=f'рецепт {i}',
+                author=cls.author,
+                text='описание',
+                image='recipes_photo/photo.png',
+                cooking_time=10,
+            )
+            for i in range(200)
+        )
+        RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(recipe=recipe, ingredient=ingredient, amount=1)
+            for recipe in recipes
+            for ingredient in ingredients
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def assert_list_queries(self, client, num):
+        for limit in (6, 50, 200):
+            with self.subTest(limit=limit), self.assertNumQueries(num):
+                response = client.get('/api/recipes/', {'limit': limit})
+            self.assertEqual(response.status_code, 200)
+            results = response.json()['results']
+            self.assertEqual(len(results), limit)
+            self.assertEqual(
+                len(results[-1]['ingredients']),
+                self.INGREDIENTS_PER_RECIPE,
+            )
+
+    def test_anonymous_list(self):
+        # count и дата изменения для ETag, страница рецептов с авторами,
+        # ингредиенты рецептов.
+        self.assert_list_queries(APIClient(), 3)
+
+    def test_authenticated_list(self):
+        client = APIClient()
+        client.force_authenticate(self.reader)
+        # Плюс сводка избранного, корзины и подписок для ETag и
+        # подписки пользователя.
+        self.assert_list_queries(client, 5)
+
+    def test_tampered_cursor(self):
+        for values in (['bad', 1], [None, 1], [[1], 1], ['2024-01-01']):
+            cursor = base64.urlsafe_b64encode(
+                json.dumps({'v': values, 'r': False}).encode(),
+            ).decode()
+            with self.subTest(values=values):
+                response = APIClient().get(
+                    '/api/recipes/',
+                    {'cursor': cursor},
+                )
+                self.assertEqual(response.status_code, 404)
+
+    def test_detail(self):
+        recipe = Recipe.objects.first()
+        # Рецепт с автором, ингредиенты рецепта; ответ попадает в кэш.
+        with self.assertNumQueries(2):
+            response = APIClient().get(f'/api/recipes/{recipe.id}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            len(response.json()['ingredients']),
+            self.INGREDIENTS_PER_RECIPE,
+        )
+        with self.assertNumQueries(0):
+            cached = APIClient().get(f'/api/recipes/{recipe.id}/')
+        self.assertEqual(cached.json(), response.json())
+        client = APIClient()
+        client.force_authenticate(self.reader)
+        Follow.objects.create(user=self.reader, author=self.author)
+        # Один запрос за флагами пользователя.
+        with self.assertNumQueries(1):
+            personal = client.get(f'/api/recipes/{recipe.id}/').json()
+        self.assertIs(personal['author']['is_subscribed'], True)
+        self.assertIs(personal['is_favorited'], False)
+
+    def test_detail_invalidation(self):
+        recipe = Recipe.objects.first()
+        APIClient().get(f'/api/recipes/{recipe.id}/')
+        item = recipe.ingredients_items.first()
+        item.amount = 5
+        item.save()
+        response = APIClient().get(f'/api/recipes/{recipe.id}/')
+        amounts = {
+            ingredient['id']: ingredient['amount']
+            for ingredient in response.json()['ingredients']
+        }
+        self.assertEqual(amounts[item.ingredient_id], 5)
+        self.author.first_name = 'Повар'
+        self.author.save()
+        response = APIClient().get(f'/api/recipes/{recipe.id}/')
+        self.assertEqual(response.json()['author']['first_name'], 'Повар')
+        # Запись, сохранённая по данным до изменения рецепта.
+        Recipe.objects.filter(pk=recipe.pk).update(
+            name='Новое название',
+            updated_at=timezone.now(),
+        )
+        client = APIClient()
+        client.force_authenticate(self.reader)
+        response = client.get(f'/api/recipes/{recipe.id}/')
+        self.assertEqual(response.json()['name'], 'Новое название')
+
+    def test_not_modified(self):
+        recipe = Recipe.objects.first()
+        client = APIClient()
+        client.force_authenticate(self.reader)
+        for url, num in (
+            ('/api/recipes/', 2),
+            (f'/api/recipes/{recipe.id}/', 1),
+        ):
+            with self.subTest(url=url):
+                etag = client.get(url)['ETag']
+                # Только запросы для вычисления ETag.
+                with self.assertNumQueries(num):
+                    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+                Favorite.objects.create(user=self.reader, recipe=recipe)
+                response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 200)
+                Favorite.objects.all().delete()
+
+    def test_not_modified_after_ingredients_change(self):
+        recipe = Recipe.objects.first()
+        ingredient = Ingredient.objects.create(
+            name='новый ингредиент',
+            measurement_unit='г',
+        )
+        client = APIClient()
+        for url in ('/api/recipes/', f'/api/recipes/{recipe.id}/'):
+            with self.subTest(url=url):
+                etag = client.get(url)['ETag']
+                item = RecipeIngredient.objects.create(
+                    recipe=recipe,
+                    ingredient=ingredient,
+                    amount=1,
+                )
+                response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 200)
+                etag = response['ETag']
+                item.delete()
+                response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 200)
+
+
+class ShoppingListTest(TestCase):
+    """Список покупок совпадает с корзиной при любом пути изменений."""
+
+    def setUp(self):
+        self.author = User.objects.create(
+            username='author',
+            email='author@example.com',
+        )
+        self.buyer = User.objects.create(
+            username='buyer',
+            email='buyer@example.com',
+        )
+        self.ingredient = Ingredient.objects.create(
+            name='мука',
+            measurement_unit='г',
+        )
+        self.recipe = Recipe.objects.create(
+            name='блины',
+            author=self.author,
+            text='описание',
+            image='recipes_photo/photo.png',
+            cooking_time=10,
+        )
+        self.item = RecipeIngredient.objects.create(
+            recipe=self.recipe,
+            ingredient=self.ingredient,
+            amount=2,
+        )
+        ShoppingCart.objects.create(user=self.buyer, recipe=self.recipe)
+
+    def shopping_list(self):
+        return list(
+            ShoppingListItem.objects.filter(user=self.buyer).values_list(
+                'ingredient_id',
+                'amount',
+            ),
+        )
+
+    def test_cart(self):
+        self.assertEqual(self.shopping_list(), [(self.ingredient.id, 2)])
+        self.item.amount = 5
+        self.item.save()
+        self.assertEqual(self.shopping_list(), [(self.ingredient.id, 5)])
+        ShoppingCart.objects.all().delete()
+        self.assertEqual(self.shopping_list(), [])
+
+    def test_author_deleted(self):
+        self.assertEqual(self.shopping_list(), [(self.ingredient.id, 2)])
+        self.author.delete()
+        self.assertFalse(ShoppingCart.objects.exists())
+        self.assertEqual(self.shopping_list(), [])
+
+
+@mock.patch.object(catalog, 'GENERATION_CHECK_INTERVAL', -1)
+class RecipeIngredientIndexTest(TestCase):
+    """Индекс подбора рецептов обновляется по журналу изменений."""
+
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create(
+            username='author',
+            email='author@example.com',
+        )
+        self.flour, self.salt, self.milk = Ingredient.objects.bulk_create(
+            Ingredient(name=name, measurement_unit='г')
+            for name in ('мука', 'соль', 'молоко')
+        )
+        self.bread = self.create_recipe('хлеб', self.flour, self.salt)
+        self.pasta = self.create_recipe('паста', self.flour)
+        self.index = catalog.RecipeIngredientIndex()
+
+    def create_recipe(self, name, *ingredients):
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe = Recipe.objects.create(
+                name=name,
+                author=self.author,
+                text='описание',
+                image='recipes_photo/photo.png',
+                cooking_time=10,
+            )
+            for ingredient in ingredients:
+                RecipeIngredient.objects.create(
+                    recipe=recipe,
+                    ingredient=ingredient,
+                    amount=1,
+                )
+        return recipe
+
+    def rank(self, *ingredients):
+        return self.index.rank(
+            [ingredient.id for ingredient in ingredients],
+            10,
+        )
+
+    def test_rank(self):
+        self.assertEqual(
+            self.rank(self.flour),
+            [(self.pasta.id, 1, 1), (self.bread.id, 1, 2)],
+        )
+        self.assertEqual(
+            self.rank(self.flour, self.salt),
+            [(self.pasta.id, 1, 1), (self.bread.id, 2, 2)],
+        )
+        self.assertEqual(self.rank(self.milk), [])
+
+    def test_changes(self):
+        self.rank(self.flour)
+        data = self.index._data
+        pancakes = self.create_recipe('блины', self.flour, self.milk)
+        self.assertEqual(self.rank(self.milk), [(pancakes.id, 1, 2)])
+        with self.captureOnCommitCallbacks(execute=True):
+            RecipeIngredient.objects.filter(
+                recipe=self.bread,
+                ingredient=self.salt,
+            ).delete()
+        self.assertEqual(self.rank(self.salt), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pasta.delete()
+        self.assertEqual(
+            self.rank(self.flour),
+            [(self.bread.id, 1, 1), (pancakes.id, 1, 2)],
+        )
+        # Изменения применены к индексу, а не построены заново.
+        self.assertIs(self.index._data, data)
+
+    @mock.patch.object(catalog, 'has_atomic_incr', lambda: False)
+    def test_changes_without_atomic_incr(self):
+        self.rank(self.flour)
+        data = self.index._data
+        pancakes = self.create_recipe('блины', self.flour, self.milk)
+        self.assertEqual(self.rank(self.milk), [(pancakes.id, 1, 2)])
+        self.assertIsNot(self.index._data, data)
@@ -2,6 +2,7 @@ from django.urls import include, path
 from rest_framework import routers
 
 from .views import (
+    CacheStatsView,
     FollowViewSet,
     IngredientViewSet,
     RecipeViewSet,
@@ -14,6 +15,7 @@ router.register(r'recipes', RecipeViewSet)
 router.register(r'users', FollowViewSet, basename='users')
 
 urlpatterns = [
+    path('cache/stats/', CacheStatsView.as_view(), name='cache_stats'),
     path('', include(router.urls)),
     path('', include('djoser.urls')),
     path('auth/', include('djoser.urls.authtoken')),
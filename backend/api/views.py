@@ -1,47 +1,91 @@
-import base64
-import csv
 import hashlib
-import io
 import logging
 
 from django.conf import settings
-from django.core.cache import cache
-from django.db.models import Sum
-from django.http import HttpResponse
-from django.shortcuts import get_object_or_404, redirect
+from django.db import transaction
+from django.db.models import (
+    Count,
+    Exists,
+    F,
+    Max,
+    OuterRef,
+    Prefetch,
+    Value,
+    Window,
+)
+from django.db.models.functions import RowNumber
+from django.http import HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import quote_etag
 from djoser.views import UserViewSet
 from rest_framework import status, viewsets
 from rest_framework.decorators import action
-from rest_framework.exceptions import PermissionDenied
-from rest_framework.pagination import LimitOffsetPagination
+from rest_framework.exceptions import NotFound, PermissionDenied
 from rest_framework.permissions import (
+    IsAdminUser,
     IsAuthenticated,
     IsAuthenticatedOrReadOnly
 )
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
+from . import recipe_cache, search, shortlinks
+from .catalog import (
+    ingredient_index,
+    ingredient_snapshot,
+    recipe_ingredient_index,
+)
+from .conditional import (
+    make_etag,
+    not_modified,
+    set_validators,
+    user_state,
+)
+from .middleware import short_link_response
+from .pagination import KeysetPagination
+from .renderers import (
+    ShoppingListCSVRenderer,
+    ShoppingListJSONRenderer,
+    ShoppingListTSVRenderer,
+)
 from .serializers import (
     AddAvatar,
     AddFavorite,
+    CookableRecipeSerializer,
     FollowSerializer,
     IngredientSerializer,
     RecipeSerializer,
     UserSerializer,
 )
+from foodgram.cache import backend_info as cache_backend_info
+from foodgram.cache import stats as cache_stats
 from recipes.models import (
     Favorite,
+    FeedEntry,
     Follow,
     Ingredient,
     Recipe,
     RecipeIngredient,
     RecipeShortLink,
     ShoppingCart,
+    ShoppingListItem,
     User,
+    score_cache,
 )
 
 
 logger = logging.getLogger(__name__)
 
+INGREDIENT_SNAPSHOT_MAX_AGE = 60 * 60 * 24
+BY_INGREDIENTS_LIMIT = 20
+BY_INGREDIENTS_MAX_LIMIT = 100
+# Значения параметра ordering списка рецептов и их ключи сортировки
+RECIPE_ORDERINGS = {
+    'popular': ('-popular_score', '-id'),
+    'trending': ('-trending_score', '-id'),
+}
+
 
 ERRORS = {
     'self_subscribe': 'На самого себя подписаться нельзя',
@@ -55,6 +99,7 @@ ERRORS = {
     'no_image': 'Необходимо загрузить изображение',
     'cant_edit': 'Вы не можете изменить чужой рецепт',
     'cant_delete': 'Вы не можете удалить чужой рецепт',
+    'no_ingredients': 'Укажите id ингредиентов в параметре ingredients',
 }
 
 
@@ -63,19 +108,53 @@ class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
     serializer_class = IngredientSerializer
     pagination_class = None
 
-    def get_queryset(self):
-        queryset = Ingredient.objects.all()
-        name = self.request.query_params.get('name')
+    def list(self, request, *args, **kwargs):
+        name = request.query_params.get('name')
         if name:
-            return queryset.filter(name__istartswith=name)
-        return queryset
+            return Response(ingredient_index.search(name))
+        return super().list(request, *args, **kwargs)
+
+    @action(detail=False, methods=['get'], url_path='snapshot')
+    def snapshot(self, request):
+        """Весь каталог одним готовым JSON со строгим ETag.
+
+        Тело собрано и сжато заранее, сериализаторы не вызываются.
+        """
+        version, encoding, content = ingredient_snapshot.get(
+            request.META.get('HTTP_ACCEPT_ENCODING', ''),
+        )
+        etag = quote_etag(f'{version}-{encoding}' if encoding else version)
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = HttpResponse(content, content_type='application/json')
+            if encoding:
+                response['Content-Encoding'] = encoding
+        response['ETag'] = etag
+        response['X-Catalog-Version'] = version
+        response['Cache-Control'] = (
+            f'public, max-age={INGREDIENT_SNAPSHOT_MAX_AGE}'
+        )
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
 
 
 class FollowViewSet(UserViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = (IsAuthenticatedOrReadOnly,)
-    pagination_class = LimitOffsetPagination
+    pagination_class = KeysetPagination
+    cursor_ordering = ('id',)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        user = self.request.user
+        if user.is_authenticated:
+            return queryset.annotate(
+                is_subscribed=Exists(
+                    Follow.objects.filter(user=user, author=OuterRef('pk')),
+                ),
+            )
+        return queryset.annotate(is_subscribed=Value(False))
 
     @action(
         detail=True,
@@ -97,7 +176,9 @@ class FollowViewSet(UserViewSet):
                     {'errors': ERRORS['already_subscribed']},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
-            Follow.objects.create(user=user, author=author)
+            with transaction.atomic():
+                Follow.objects.create(user=user, author=author)
+                FeedEntry.objects.add_author(user, author)
             serializer = FollowSerializer(author, context={'request': request})
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         if request.method == 'DELETE':
@@ -107,7 +188,9 @@ class FollowViewSet(UserViewSet):
                     {'errors': ERRORS['not_subscribed']},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
-            follow.delete()
+            with transaction.atomic():
+                follow.delete()
+                FeedEntry.objects.remove_author(user, author)
             return Response(status=status.HTTP_204_NO_CONTENT)
         return Response(
             {'error': 'Метод не разрешён'},
@@ -122,22 +205,54 @@ class FollowViewSet(UserViewSet):
     )
     def subscriptions(self, request):
         user = request.user
-        queryset = User.objects.filter(
-            following__user=user,
-        ).prefetch_related('recipes')
-        if not queryset:
+        recipes_stats = Recipe.objects.filter(
+            author__following__user=user,
+        ).aggregate(count=Count('id'), updated_at=Max('updated_at'))
+        etag = make_etag(
+            'subscriptions',
+            request.get_host(),
+            request.get_full_path(),
+            recipes_stats['count'],
+            recipes_stats['updated_at'],
+            user_state(user, models=(Follow,)),
+        )
+        response = not_modified(request, etag)
+        if response is not None:
+            return set_validators(request, response, etag)
+        recipes = Recipe.objects.all()
+        recipes_limit = request.query_params.get('recipes_limit')
+        if recipes_limit and recipes_limit.isdigit():
+            recipes = recipes.annotate(
+                row_number=Window(
+                    RowNumber(),
+                    partition_by=F('author'),
+                    order_by=F('created_at').desc(),
+                ),
+            ).filter(row_number__lte=int(recipes_limit))
+        queryset = (
+            User.objects.filter(following__user=user)
+            .annotate(is_subscribed=Value(True))
+            .prefetch_related(Prefetch('recipes', queryset=recipes))
+            .order_by('id')
+        )
+        paginator = self.pagination_class()
+        page = paginator.paginate_queryset(queryset, request, view=self)
+        # Пустая страница бывает и у курсора за последней подпиской.
+        if not page and not Follow.objects.filter(user=user).exists():
             return Response(
                 ERRORS['no_subscriptions'],
                 status=status.HTTP_400_BAD_REQUEST,
             )
-        paginator = self.pagination_class()
-        page = paginator.paginate_queryset(queryset, request)
         serializer = FollowSerializer(
             page,
             many=True,
             context={'request': request},
         )
-        return paginator.get_paginated_response(serializer.data)
+        return set_validators(
+            request,
+            paginator.get_paginated_response(serializer.data),
+            etag,
+        )
 
     @action(
         detail=False,
@@ -165,7 +280,12 @@ class FollowViewSet(UserViewSet):
                     {'errors': ERRORS['no_image']},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
-            serializer = AddAvatar(user, data=request.data, partial=True)
+            serializer = AddAvatar(
+                user,
+                data=request.data,
+                partial=True,
+                context={'request': request},
+            )
             serializer.is_valid(raise_exception=True)
             serializer.save()
             return Response(serializer.data, status=status.HTTP_200_OK)
@@ -183,10 +303,12 @@ class RecipeViewSet(viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     serializer_class = RecipeSerializer
     permission_classes = (IsAuthenticatedOrReadOnly,)
-    pagination_class = LimitOffsetPagination
+    pagination_class = KeysetPagination
 
     def perform_create(self, serializer):
-        serializer.save(author=self.request.user)
+        with transaction.atomic():
+            recipe = serializer.save(author=self.request.user)
+            FeedEntry.objects.fan_out(recipe)
 
     def perform_update(self, serializer):
         if serializer.instance.author != self.request.user:
@@ -204,12 +326,159 @@ class RecipeViewSet(viewsets.ModelViewSet):
         context['request'] = self.request
         return context
 
+    def get_search(self):
+        """Поисковый запрос списка рецептов из ?search= или пустая строка."""
+        if self.action != 'list':
+            return ''
+        return self.request.query_params.get('search', '').strip()
+
+    def get_ordering(self):
+        """Ключ сортировки из ?ordering= или по рангу поиска, иначе None."""
+        if self.action != 'list':
+            return None
+        ordering = self.request.query_params.get('ordering')
+        if ordering in RECIPE_ORDERINGS:
+            return RECIPE_ORDERINGS[ordering]
+        if self.get_search() and search.is_ranked():
+            return search.RANK_ORDERING
+        return None
+
+    @property
+    def cursor_ordering(self):
+        return self.get_ordering() or KeysetPagination.cursor_ordering
+
+    def list(self, request, *args, **kwargs):
+        """Страница рецептов с ETag по агрегатам выборки.
+
+        Если у клиента актуальная копия, отдаётся 304 без чтения
+        страницы.
+        """
+        stats = self.filter_queryset(self.get_queryset()).aggregate(
+            count=Count('id'),
+            updated_at=Max('updated_at'),
+        )
+        etag = make_etag(
+            'recipes',
+            request.get_host(),
+            request.get_full_path(),
+            stats['count'],
+            stats['updated_at'],
+            user_state(request.user),
+            # Рейтинги меняет пересчёт, а не правка рецептов.
+            score_cache.generation() if self.get_ordering() else None,
+        )
+        response = not_modified(request, etag)
+        if response is None:
+            self.queryset_count = stats['count']
+            response = super().list(request, *args, **kwargs)
+        return set_validators(request, response, etag)
+
+    def retrieve(self, request, *args, **kwargs):
+        """Рецепт из кэша с флагами текущего пользователя.
+
+        При попадании в кэш анонимный запрос обходится без обращений
+        к базе, запрос пользователя — одним запросом за флагами и
+        датой изменения. Актуальная копия у клиента даёт 304.
+        """
+        pk = self.kwargs['pk']
+        if not pk.isdigit():
+            raise NotFound
+        recipe_id = int(pk)
+        user = request.user
+        flags = (False, False, False)
+        if user.is_authenticated:
+            row = Recipe.objects.filter(pk=recipe_id).annotate(
+                is_favorited=Exists(
+                    Favorite.objects.filter(user=user, recipe=OuterRef('pk')),
+                ),
+                is_in_shopping_cart=Exists(
+                    ShoppingCart.objects.filter(
+                        user=user,
+                        recipe=OuterRef('pk'),
+                    ),
+                ),
+                is_subscribed=Exists(
+                    Follow.objects.filter(
+                        user=user,
+                        author=OuterRef('author_id'),
+                    ),
+                ),
+            ).values_list(
+                'updated_at',
+                'is_favorited',
+                'is_in_shopping_cart',
+                'is_subscribed',
+            ).first()
+            if row is None:
+                raise NotFound
+            updated_at, *flags = row
+            etag = self.get_recipe_etag(recipe_id, updated_at, flags)
+            response = not_modified(request, etag)
+            if response is not None:
+                return set_validators(request, response, etag)
+        entry = recipe_cache.get(recipe_id, request)
+        # Запрос, прочитавший рецепт до коммита изменений, мог сохранить
+        # запись уже после её удаления: устаревшая запись — промах.
+        if entry is None or (
+            user.is_authenticated and entry[0] != updated_at
+        ):
+            instance = self.get_object()
+            entry = recipe_cache.store(
+                recipe_id,
+                request,
+                instance.updated_at,
+                self.get_serializer(instance).data,
+            )
+        cached_updated_at, data = entry
+        if not user.is_authenticated:
+            updated_at = cached_updated_at
+            etag = self.get_recipe_etag(recipe_id, updated_at, flags)
+            response = not_modified(request, etag, updated_at)
+            if response is not None:
+                return set_validators(request, response, etag, updated_at)
+        return set_validators(
+            request,
+            Response(recipe_cache.with_flags(data, *flags)),
+            etag,
+            updated_at,
+        )
+
+    def get_recipe_etag(self, recipe_id, updated_at, flags):
+        return make_etag(
+            'recipe',
+            recipe_id,
+            recipe_cache.variant(self.request),
+            updated_at.isoformat(),
+            *flags,
+        )
+
     def get_queryset(self):
         queryset = Recipe.objects.select_related('author').prefetch_related(
-            'ingredients',
-        )
+            Prefetch(
+                'ingredients_items',
+                queryset=RecipeIngredient.objects.select_related('ingredient'),
+            ),
+        ).defer('search_vector')
+        user = self.request.user
+        if user.is_authenticated:
+            queryset = queryset.annotate(
+                is_favorited=Exists(
+                    Favorite.objects.filter(user=user, recipe=OuterRef('pk')),
+                ),
+                is_in_shopping_cart=Exists(
+                    ShoppingCart.objects.filter(
+                        user=user,
+                        recipe=OuterRef('pk'),
+                    ),
+                ),
+            )
+        else:
+            queryset = queryset.annotate(
+                is_favorited=Value(False),
+                is_in_shopping_cart=Value(False),
+            )
         filters = {}
-        if self.request.user.is_authenticated:
+        if user.is_authenticated:
             author = self.request.query_params.get('author')
             is_in_shopping_cart = self.request.query_params.get(
                 'is_in_shopping_cart',
@@ -218,10 +487,16 @@ class RecipeViewSet(viewsets.ModelViewSet):
             if author:
                 filters['author_id'] = author
             if is_in_shopping_cart:
-                filters['shoppingcart__user'] = self.request.user
+                filters['is_in_shopping_cart'] = True
             if is_favorited:
-                filters['favorite__user'] = self.request.user
-        return queryset.filter(**filters).distinct()
+                filters['is_favorited'] = True
+        query = self.get_search()
+        if query:
+            queryset = search.search_recipes(queryset, query)
+        ordering = self.get_ordering()
+        if ordering:
+            queryset = queryset.order_by(*ordering)
+        return queryset.filter(**filters)
 
     @action(
         detail=True,
@@ -238,8 +513,10 @@ class RecipeViewSet(viewsets.ModelViewSet):
                     {'error': ERRORS['already_in_favorites']},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
-            Favorite.objects.create(user=user, recipe=recipe)
-            serializer = AddFavorite(recipe)
+            # Счётчик рецепта обновляет сигнал в той же транзакции.
+            with transaction.atomic():
+                Favorite.objects.create(user=user, recipe=recipe)
+            serializer = AddFavorite(recipe, context={'request': request})
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         if request.method == 'DELETE':
             favorite = Favorite.objects.filter(recipe=recipe, user=user)
@@ -270,8 +547,10 @@ class RecipeViewSet(viewsets.ModelViewSet):
                     {'error': ERRORS['already_in_cart']},
                     status=status.HTTP_400_BAD_REQUEST,
                 )
-            ShoppingCart.objects.create(user=user, recipe=recipe)
-            serializer = AddFavorite(recipe)
+            # Список покупок обновляет сигнал в той же транзакции.
+            with transaction.atomic():
+                ShoppingCart.objects.create(user=user, recipe=recipe)
+            serializer = AddFavorite(recipe, context={'request': request})
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         if request.method == 'DELETE':
             shopping_cart = ShoppingCart.objects.filter(
@@ -295,74 +574,150 @@ class RecipeViewSet(viewsets.ModelViewSet):
         methods=('get',),
         permission_classes=[IsAuthenticated],
         url_path='download_shopping_cart',
+        renderer_classes=[
+            ShoppingListTSVRenderer,
+            ShoppingListCSVRenderer,
+            ShoppingListJSONRenderer,
+        ],
     )
     def download_shopping_cart(self, request):
+        """Потоковая выгрузка списка покупок в формате ?format=tsv|csv|json.
+
+        ETag строится по версии списка, поэтому повторный запрос с
+        If-None-Match получает 304 без чтения строк.
+        """
         user = request.user
-        cache_key = f'shopping_cart_{user.id}'
-        cached_data = cache.get(cache_key)
-        if cached_data:
-            response = HttpResponse(cached_data, content_type='text/csv')
-            response['Content-Disposition'] = '''
-                attachment; filename="shopping_list.txt"
-            '''
-            return response
-        ingredients = (
-            RecipeIngredient.objects.filter(recipe__shoppingcart__user=user)
-            .values('ingredient__name', 'ingredient__measurement_unit')
-            .annotate(total_amount=Sum('amount'))
-            .order_by('ingredient__name'),
+        renderer = request.accepted_renderer
+        version = ShoppingListItem.objects.version(user)
+        etag = quote_etag(
+            hashlib.md5(
+                f'{user.id}:{renderer.format}:{version}'.encode(),
+            ).hexdigest(),
         )
-        buffer = io.StringIO()
-        writer = csv.writer(buffer, delimiter='\t')
-        writer.writerow(['Список покупок'])
-        writer.writerow(['Ингредиенты', 'Количество', 'Единицы измерения'])
-        for item in ingredients:
-            writer.writerow(
-                [
-                    item['ingredient__name'],
-                    item['total_amount'],
-                    item['ingredient__measurement_unit'],
-                ]
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            ingredients = (
+                ShoppingListItem.objects.filter(user=user)
+                .values_list(
+                    'ingredient__name',
+                    'amount',
+                    'ingredient__measurement_unit',
+                )
+                .order_by('ingredient__name')
+                .iterator(chunk_size=500)
+            )
+            response = StreamingHttpResponse(
+                renderer.stream(ingredients),
+                content_type=f'{renderer.media_type}; charset=utf-8',
             )
-        content = buffer.getvalue()
-        buffer.close()
-        cache.set(cache_key, content, 300)
-        response = HttpResponse(content, content_type='text/csv')
-        response['Content-Disposition'] = '''
-            attachment; filename="shopping_list.txt"
-        '''
+            response['Content-Disposition'] = (
+                f'attachment; filename="shopping_list.{renderer.format}"'
+            )
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        patch_vary_headers(response, ('Authorization',))
         return response
 
+    @action(
+        detail=False,
+        methods=['get'],
+        permission_classes=[IsAuthenticated],
+    )
+    def feed(self, request):
+        """Рецепты авторов из подписок пользователя, новые первыми."""
+        queryset = self.get_queryset().filter(
+            FeedEntry.objects.recipes_filter(request.user),
+        ).order_by('-created_at', '-id')
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @action(
+        detail=False,
+        methods=['get'],
+        url_path='by_ingredients',
+    )
+    def by_ingredients(self, request):
+        """Рецепты, которые можно приготовить из ингредиентов в наличии.
+
+        Id ингредиентов передаются в ?ingredients= через запятую или
+        повтором параметра. Рецепты ранжируются по обратному индексу в
+        памяти, из базы читаются только limit лучших.
+        """
+        available = {
+            int(value)
+            for values in request.query_params.getlist('ingredients')
+            for value in values.split(',')
+            if value.strip().isdigit()
+        }
+        if not available:
+            return Response(
+                {'errors': ERRORS['no_ingredients']},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        limit = request.query_params.get('limit', '')
+        limit = min(
+            int(limit) if limit.isdigit() else BY_INGREDIENTS_LIMIT,
+            BY_INGREDIENTS_MAX_LIMIT,
+        )
+        ranked = recipe_ingredient_index.rank(available, limit)
+        recipes = Recipe.objects.prefetch_related(
+            Prefetch(
+                'ingredients_items',
+                queryset=RecipeIngredient.objects.select_related('ingredient'),
+            ),
+        ).defer('search_vector').in_bulk(
+            [recipe_id for recipe_id, _, _ in ranked],
+        )
+        result = []
+        for recipe_id, matched, total in ranked:
+            recipe = recipes.get(recipe_id)
+            if recipe is None:
+                continue
+            recipe.matched_count = matched
+            recipe.coverage = round(matched / total, 4)
+            result.append(recipe)
+        serializer = CookableRecipeSerializer(
+            result,
+            many=True,
+            context={'request': request, 'available': available},
+        )
+        return Response(serializer.data)
+
     @action(detail=True, methods=['get'], url_path='get-link')
     def get_link(self, request, pk=None):
-        recipe = self.get_object()
-        hash_input = f'{recipe.id}{recipe.name}{recipe.created_at}'
-        url_hash = self.generate_hash(hash_input)
-        short_link, created = RecipeShortLink.objects.get_or_create(
-            recipe=recipe,
-            defaults={'url_hash': url_hash},
-        )
-        short_url = f'{settings.BASE_URL}/a/r/{short_link.url_hash}'
+        if not pk.isdigit():
+            raise NotFound
+        recipe_id = int(pk)
+        url_hash = shortlinks.encode(recipe_id)
+        if shortlinks.cache.get(url_hash) != recipe_id:
+            url_hash = RecipeShortLink.objects.filter(
+                recipe_id=recipe_id,
+            ).values_list('url_hash', flat=True).first()
+            if url_hash is None:
+                if not Recipe.objects.filter(pk=recipe_id).exists():
+                    raise NotFound
+                short_link, created = RecipeShortLink.objects.get_or_create(
+                    recipe_id=recipe_id,
+                    defaults={'url_hash': shortlinks.encode(recipe_id)},
+                )
+                url_hash = short_link.url_hash
+            shortlinks.warm(url_hash, recipe_id)
+        short_url = f'{settings.BASE_URL}/a/r/{url_hash}'
         return Response({'short-link': short_url})
 
-    def generate_hash(self, input_str):
-        """Генерация хэша, состоящего из восьми символов."""
-        hash_bytes = hashlib.sha256(input_str.encode()).digest()
-        return base64.urlsafe_b64encode(hash_bytes).decode()[:8]
 
+class CacheStatsView(APIView):
+    """Попадания и промахи кэша по подсистемам для всех процессов."""
 
-def redirect_by_hash(request, url_hash):
-    try:
-        cache_key = f'recipe_hash_{url_hash}'
-        recipe_id = cache.get(cache_key)
-        if not recipe_id:
-            short_link = get_object_or_404(RecipeShortLink, url_hash=url_hash)
-            recipe_id = short_link.recipe.id
-            cache.set(cache_key, recipe_id, 3600)
-        return redirect(f'{settings.BASE_URL}/api/recipes/{recipe_id}')
-    except Exception as ex:
-        logger.error(f'Error redirecting hash {url_hash}: {str(ex)}')
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
         return Response(
-            {'error': 'Рецепт не найден'},
-            status=status.HTTP_404_NOT_FOUND,
+            {**cache_backend_info(), 'namespaces': cache_stats.totals()},
         )
+
+
+def redirect_by_hash(request, url_hash):
+    """Короткая ссылка, если запрос прошёл мимо ShortLinkRedirectMiddleware."""
+    return short_link_response(url_hash)
@@ -0,0 +1,174 @@
+"""Общий фасад над кэшем Django.
+
+Каждая подсистема работает со своим пространством имён: ключи
+получают префикс пространства и версию формата значений, так что
+смена формата не требует очистки кэша. Поколение пространства —
+общий для всех процессов счётчик, по которому сбрасываются
+производные данные в памяти процессов. Попадания и промахи
+считаются в процессе и периодически суммируются в общем кэше.
+"""
+
+import logging
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+STATS_KEY = 'stats:{}:{}'
+STATS_OUTCOMES = ('hit', 'miss')
+# Бэкенды, у которых incr атомарен. У file и db это чтение и запись,
+# и два процесса могут получить одно и то же значение; locmem
+# увеличивает значение под блокировкой, но только в своём процессе.
+ATOMIC_INCR_BACKENDS = (
+    'RedisCache',
+    'PyMemcacheCache',
+    'PyLibMCCache',
+    'LocMemCache',
+)
+MISSING = object()
+
+namespaces = {}
+
+
+class CacheStats:
+    """Счётчики обращений к кэшу по пространствам имён."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = Counter()
+        self._flushed_at = time.monotonic()
+
+    def record(self, namespace, outcome, count=1):
+        with self._lock:
+            self._pending[namespace, outcome] += count
+            if (
+                time.monotonic() - self._flushed_at
+                < settings.CACHE_STATS_FLUSH_INTERVAL
+            ):
+                return
+            pending, self._pending = self._pending, Counter()
+            self._flushed_at = time.monotonic()
+        self._flush(pending)
+
+    def _flush(self, pending):
+        for (namespace, outcome), count in pending.items():
+            key = STATS_KEY.format(namespace, outcome)
+            try:
+                cache.add(key, 0, timeout=None)
+                cache.incr(key, count)
+            except Exception as ex:
+                logger.warning(f'Cache stats are not saved: {ex}')
+                return
+
+    def totals(self):
+        """Счётчики из общего кэша плюс ещё не сброшенные в этом процессе."""
+        with self._lock:
+            pending = Counter(self._pending)
+        keys = {
+            STATS_KEY.format(name, outcome): (name, outcome)
+            for name, namespace in namespaces.items()
+            for outcome in namespace.outcomes
+        }
+        stored = cache.get_many(keys)
+        result = {}
+        for key, (name, outcome) in keys.items():
+            result.setdefault(name, {})[outcome] = (
+                stored.get(key, 0) + pending[name, outcome]
+            )
+        return result
+
+
+stats = CacheStats()
+
+
+class CacheNamespace:
+    """Ключи одной подсистемы в общем кэше.
+
+    version — версия формата значений, её повышают при изменении
+    того, что подсистема кладёт в кэш.
+    """
+
+    def __init__(self, name, timeout=None, version=1, outcomes=()):
+        self.name = name
+        self.timeout = timeout
+        self.version = version
+        self.outcomes = STATS_OUTCOMES + tuple(outcomes)
+        namespaces[name] = self
+
+    def make_key(self, key):
+        return f'{self.name}:{key}'
+
+    def get(self, key, default=None):
+        value = cache.get(self.make_key(key), MISSING, version=self.version)
+        if value is MISSING:
+            self.record('miss')
+            return default
+        self.record('hit')
+        return value
+
+    def get_many(self, keys):
+        """Словарь найденных значений по исходным ключам."""
+        keys = {self.make_key(key): key for key in keys}
+        found = cache.get_many(list(keys), version=self.version)
+        self.record('hit', len(found))
+        self.record('miss', len(keys) - len(found))
+        return {keys[key]: value for key, value in found.items()}
+
+    def set(self, key, value, timeout=MISSING):
+        cache.set(
+            self.make_key(key),
+            value,
+            self.timeout if timeout is MISSING else timeout,
+            version=self.version,
+        )
+
+    def delete_many(self, keys):
+        cache.delete_many(
+            [self.make_key(key) for key in keys],
+            version=self.version,
+        )
+
+    def record(self, outcome, count=1):
+        stats.record(self.name, outcome, count)
+
+    def generation(self):
+        """Текущее поколение пространства имён, общее для процессов."""
+        return cache.get_or_set(
+            self.make_key('generation'),
+            0,
+            timeout=None,
+            version=self.version,
+        )
+
+    def bump(self):
+        """Объявляет производные данные всех процессов устаревшими.
+
+        Возвращает новое поколение. Оно уникально, только если
+        has_atomic_incr().
+        """
+        key = self.make_key('generation')
+        cache.add(key, 0, timeout=None, version=self.version)
+        try:
+            return cache.incr(key, version=self.version)
+        except ValueError:
+            # Ключ вытеснен между add и incr.
+            cache.set(key, 1, timeout=None, version=self.version)
+            return 1
+
+
+def backend_info():
+    options = settings.CACHES['default']
+    return {
+        'backend': options['BACKEND'].rsplit('.', 1)[-1],
+        'key_prefix': options.get('KEY_PREFIX', ''),
+    }
+
+
+def has_atomic_incr():
+    """Даёт ли incr общего кэша разные значения конкурентным вызовам."""
+    return backend_info()['backend'] in ATOMIC_INCR_BACKENDS
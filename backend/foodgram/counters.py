@@ -0,0 +1,35 @@
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+
+class CounterFieldsMixin:
+    """Модель с полями, которые пишутся в обход save().
+
+    counter_fields — счётчики, их меняет только increment().
+    derived_fields — поля, которые пересчитываются отдельно, например
+    рейтинги, поисковый вектор и копии изображений. save() загруженного
+    объекта не пишет ни те, ни другие, чтобы значения, прочитанные
+    раньше, не затёрли результат конкурентного изменения.
+    """
+
+    counter_fields = ()
+    derived_fields = ()
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            excluded = set(self.counter_fields) | set(self.derived_fields)
+            kwargs['update_fields'] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in excluded
+            ]
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def increment(cls, pk, field, delta=1):
+        """Атомарно меняет счётчик строки pk, не опускаясь ниже нуля."""
+        if field not in cls.counter_fields:
+            raise ValueError(f'{cls.__name__}.{field} is not a counter.')
+        cls.objects.filter(pk=pk).update(
+            **{field: Greatest(F(field) + delta, 0)},
+        )
@@ -0,0 +1,258 @@
+"""Приём загруженных изображений и построение уменьшенных копий.
+
+Base64-строка декодируется порциями во временный файл, размер в
+байтах проверяется до декодирования, размер в пикселях — по
+заголовку до полного разбора Pillow. Уменьшенные копии (thumb, card,
+full) строятся в пуле потоков после коммита транзакции, их имена
+записываются в JSON-поле модели.
+"""
+
+import base64
+import io
+import logging
+import math
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import connection, transaction
+from django.dispatch import Signal
+from PIL import Image, ImageOps, features
+
+
+logger = logging.getLogger(__name__)
+
+DECODE_CHUNK_SIZE = 64 * 1024
+SPOOL_MAX_SIZE = 1024 * 1024
+
+ERROR_MESSAGES = {
+    'too_large': 'Размер изображения превышает {limit} МБ.',
+    'too_many_pixels': 'Разрешение изображения превышает {limit} Мпикс.',
+    'invalid_image': 'Загрузите корректное изображение.',
+}
+
+# Отправляется с sender=модель и pk после сохранения копий.
+renditions_built = Signal()
+
+# Потоки запускаются при первой задаче.
+executor = ThreadPoolExecutor(
+    max_workers=settings.IMAGE_RENDITION_WORKERS,
+    thread_name_prefix='renditions',
+)
+
+
+def decode_base64(data, name):
+    """Декодирует base64-строку в файл, не создавая копию в памяти.
+
+    Размер результата оценивается по длине строки и проверяется до
+    декодирования.
+    """
+    data = data.strip()
+    decoded_size = len(data) * 3 // 4 - data[-2:].count('=')
+    if decoded_size > settings.IMAGE_MAX_BYTES:
+        raise ValidationError(
+            ERROR_MESSAGES['too_large'].format(
+                limit=settings.IMAGE_MAX_BYTES // (1024 * 1024),
+            ),
+        )
+    file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    step = DECODE_CHUNK_SIZE * 4
+    for start in range(0, len(data), step):
+        file.write(base64.b64decode(data[start:start + step], validate=True))
+    file.seek(0)
+    return File(file, name=name)
+
+
+def check_image(file):
+    """Проверяет разрешение по заголовку изображения, не декодируя его."""
+    try:
+        with Image.open(file) as image:
+            width, height = image.size
+    except (OSError, Image.DecompressionBombError):
+        raise ValidationError(ERROR_MESSAGES['invalid_image'])
+    finally:
+        file.seek(0)
+    if width * height > settings.IMAGE_MAX_PIXELS:
+        raise ValidationError(
+            ERROR_MESSAGES['too_many_pixels'].format(
+                limit=settings.IMAGE_MAX_PIXELS // 1_000_000,
+            ),
+        )
+
+
+BLURHASH_ALPHABET = (
+    '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    'abcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+)
+BLURHASH_COMPONENTS = (4, 3)
+BLURHASH_SAMPLE_SIZE = 32
+SRGB_TO_LINEAR = [
+    value / 12.92 if value <= 0.04045 else ((value + 0.055) / 1.055) ** 2.4
+    for value in (channel / 255 for channel in range(256))
+]
+
+
+def encode83(value, length):
+    return ''.join(
+        BLURHASH_ALPHABET[value // 83 ** (length - position - 1) % 83]
+        for position in range(length)
+    )
+
+
+def linear_to_srgb(value):
+    value = min(max(value, 0), 1)
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def blurhash(image):
+    """Строка BlurHash для размытой заглушки на время загрузки."""
+    image = image.convert('RGB')
+    image.thumbnail((BLURHASH_SAMPLE_SIZE, BLURHASH_SAMPLE_SIZE))
+    width, height = image.size
+    pixels = [
+        [SRGB_TO_LINEAR[channel] for channel in pixel]
+        for pixel in image.getdata()
+    ]
+    x_components, y_components = BLURHASH_COMPONENTS
+    factors = []
+    for j in range(y_components):
+        basis_y = [math.cos(math.pi * j * y / height) for y in range(height)]
+        for i in range(x_components):
+            basis_x = [math.cos(math.pi * i * x / width) for x in range(width)]
+            normalisation = 1 if i == j == 0 else 2
+            red = green = blue = 0
+            for index, (r, g, b) in enumerate(pixels):
+                y, x = divmod(index, width)
+                basis = basis_x[x] * basis_y[y]
+                red += basis * r
+                green += basis * g
+                blue += basis * b
+            scale = normalisation / (width * height)
+            factors.append((red * scale, green * scale, blue * scale))
+    dc, ac = factors[0], factors[1:]
+    result = encode83(x_components - 1 + (y_components - 1) * 9, 1)
+    max_value = 1
+    quantised_max = 0
+    if ac:
+        actual_max = max(abs(value) for factor in ac for value in factor)
+        quantised_max = max(0, min(82, int(actual_max * 166 - 0.5)))
+        max_value = (quantised_max + 1) / 166
+    result += encode83(quantised_max, 1)
+    result += encode83(
+        (linear_to_srgb(dc[0]) << 16)
+        + (linear_to_srgb(dc[1]) << 8)
+        + linear_to_srgb(dc[2]),
+        4,
+    )
+    for factor in ac:
+        red, green, blue = (
+            max(0, min(18, int(
+                math.copysign(abs(value / max_value) ** 0.5, value) * 9 + 9.5
+            )))
+            for value in factor
+        )
+        result += encode83(red * 19 * 19 + green * 19 + blue, 2)
+    return result
+
+
+def rendition_format():
+    return ('WEBP', 'webp') if features.check('webp') else ('JPEG', 'jpg')
+
+
+def build_renditions(field_file):
+    """Строит уменьшенные копии изображения и сохраняет их в хранилище.
+
+    Возвращает словарь с именами файлов копий, размерами оригинала и
+    именем исходного файла в ключе source.
+    """
+    with field_file.open('rb') as source:
+        content = source.read()
+    image_format, extension = rendition_format()
+    with Image.open(io.BytesIO(content)) as original:
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ('RGB', 'RGBA'):
+            original = original.convert('RGBA')
+        if image_format == 'JPEG':
+            original = original.convert('RGB')
+        renditions = {
+            'source': field_file.name,
+            'width': original.width,
+            'height': original.height,
+            'blurhash': blurhash(original),
+        }
+        directory = field_file.name.rsplit('/', 1)[0]
+        for name, size in settings.IMAGE_RENDITIONS.items():
+            image = original.copy()
+            image.thumbnail((size, size), Image.LANCZOS)
+            buffer = io.BytesIO()
+            image.save(buffer, image_format, quality=82, method=4)
+            renditions[name] = default_storage.save(
+                f'{directory}/renditions/{name}.{extension}',
+                File(buffer),
+            )
+    return renditions
+
+
+def process_renditions(model, pk, field_name, renditions_field):
+    """Строит копии и сохраняет их, если изображение ещё не заменили."""
+    try:
+        instance = model.objects.filter(pk=pk).first()
+        if instance is None:
+            return
+        field_file = getattr(instance, field_name)
+        # Хранилище адресует файлы по содержимому, поэтому у копий
+        # одного изображения совпадает имя файла.
+        renditions = model.objects.filter(
+            **{f'{renditions_field}__source': field_file.name},
+            **{f'{renditions_field}__has_key': 'blurhash'},
+        ).exclude(pk=pk).values_list(renditions_field, flat=True).first()
+        if renditions is None:
+            renditions = build_renditions(field_file)
+        updated = model.objects.filter(
+            pk=pk,
+            **{field_name: field_file.name},
+        ).update(**{renditions_field: renditions})
+        if updated:
+            renditions_built.send(sender=model, pk=pk)
+    except Exception as ex:
+        logger.error(
+            f'Error building renditions for {model.__name__} {pk}: {ex}',
+        )
+
+
+def process_renditions_in_worker(*args):
+    try:
+        process_renditions(*args)
+    finally:
+        connection.close()
+
+
+def schedule_renditions(instance, field_name, renditions_field):
+    """Ставит построение копий в очередь после коммита транзакции.
+
+    Ничего не делает, если копии уже построены для текущего файла;
+    для удалённого изображения очищает поле копий.
+    """
+    field_file = getattr(instance, field_name)
+    renditions = getattr(instance, renditions_field) or {}
+    model = type(instance)
+    if not field_file:
+        if renditions:
+            model.objects.filter(pk=instance.pk).update(
+                **{renditions_field: {}},
+            )
+        return
+    if renditions.get('source') == field_file.name:
+        return
+    args = (model, instance.pk, field_name, renditions_field)
+    if settings.IMAGE_RENDITIONS_ASYNC:
+        transaction.on_commit(
+            lambda: executor.submit(process_renditions_in_worker, *args),
+        )
+    else:
+        transaction.on_commit(lambda: process_renditions(*args))
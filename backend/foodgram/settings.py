@@ -68,10 +68,11 @@ LOCAL_APPS = [
 INSTALLED_APPS = DJANGO_APPS + THIRD_PARTY_APPS + LOCAL_APPS
 
 MIDDLEWARE = [
+    'api.middleware.ShortLinkRedirectMiddleware',
     'corsheaders.middleware.CorsMiddleware',
+    'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -169,8 +170,39 @@ STATICFILES_DIRS = []
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Загружаемые изображения и их уменьшенные копии
+IMAGE_MAX_BYTES = 10 * 1024 * 1024
+IMAGE_MAX_PIXELS = 40_000_000
+IMAGE_RENDITIONS = {'thumb': 320, 'card': 720, 'full': 1600}
+IMAGE_RENDITIONS_ASYNC = True
+IMAGE_RENDITION_WORKERS = int(os.getenv('IMAGE_RENDITION_WORKERS', 2))
+
+# Медиафайлы хранятся по хэшу содержимого, см. foodgram.storage.
 # ManifestStaticFilesStorage отключается для отладки проблем со статикой
-STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.StaticFilesStorage'
+STORAGES = {
+    'default': {
+        'BACKEND': 'foodgram.storage.ContentAddressedStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+}
+
+# Длина ленты подписок пользователя и число подписчиков, начиная с
+# которого рецепты автора добавляются в ленты при чтении
+FEED_LENGTH = 500
+FEED_FANOUT_LIMIT = int(os.getenv('FEED_FANOUT_LIMIT', 1000))
+
+# Вклад добавления в избранное и в корзину в рейтинги рецептов и
+# период его полураспада в секундах для каждого рейтинга
+RECIPE_SCORE_WEIGHTS = {'favorite': 1.0, 'shopping_cart': 0.5}
+RECIPE_SCORE_HALF_LIVES = {
+    'popular': 30 * 24 * 60 * 60,
+    'trending': 24 * 60 * 60,
+}
+
+# Файлы без ссылок удаляются сборщиком не раньше, чем через этот срок
+MEDIA_GC_GRACE_PERIOD = int(os.getenv('MEDIA_GC_GRACE_PERIOD', 24 * 60 * 60))
 
 
 # Default primary key field type
@@ -233,18 +265,55 @@ LOGGING = {
             'level': os.getenv('DJANGO_LOG_LEVEL', 'INFO'),
             'propagate': True,
         },
+        'api': {
+            'handlers': ['console'],
+            'level': os.getenv('API_LOG_LEVEL', 'INFO'),
+        },
     },
 }
 
 # Cache settings
+# CACHE_BACKEND: redis, memcached, file, db или locmem. Для file и db
+# кэш общий для всех процессов на одной машине, locmem — свой в каждом
+# процессе. Таблицу для db создаёт manage.py createcachetable.
+CACHE_BACKENDS = {
+    'redis': (
+        'django.core.cache.backends.redis.RedisCache',
+        'redis://redis:6379/0',
+    ),
+    'memcached': (
+        'django.core.cache.backends.memcached.PyMemcacheCache',
+        'memcached:11211',
+    ),
+    'file': (
+        'django.core.cache.backends.filebased.FileBasedCache',
+        '/tmp/foodgram_cache',
+    ),
+    'db': (
+        'django.core.cache.backends.db.DatabaseCache',
+        'cache_table',
+    ),
+    'locmem': (
+        'django.core.cache.backends.locmem.LocMemCache',
+        'unique-snowflake',
+    ),
+}
+CACHE_BACKEND, CACHE_LOCATION = CACHE_BACKENDS[
+    os.getenv('CACHE_BACKEND', 'locmem')
+]
+
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'unique-snowflake',
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': os.getenv('CACHE_LOCATION', CACHE_LOCATION),
         'TIMEOUT': 300,
+        'KEY_PREFIX': os.getenv('CACHE_KEY_PREFIX', 'foodgram'),
     },
 }
 
+# Как часто процесс сбрасывает свои счётчики попаданий в общий кэш
+CACHE_STATS_FLUSH_INTERVAL = 10
+
 # Настройки CORS
 CORS_ALLOWED_ORIGINS = [
     'http://localhost:3000',
@@ -0,0 +1,41 @@
+import hashlib
+import os
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+
+HASH_CHUNK_SIZE = 64 * 1024
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """Файловое хранилище с именами по SHA-256 содержимого.
+
+    Файл сохраняется как <каталог>/<sha256><расширение>, где каталог
+    берётся из upload_to. Одинаковые байты хранятся один раз: если
+    файл с таким хэшем уже есть, запись пропускается и возвращается
+    имя существующего файла. Файлы без ссылок из базы удаляет команда
+    collect_media_garbage.
+    """
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        digest = hashlib.sha256()
+        for chunk in content.chunks(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+        content.seek(0)
+        name = os.path.join(
+            os.path.dirname(name),
+            digest.hexdigest() + os.path.splitext(name)[1].lower(),
+        )
+        if self.exists(name):
+            # Свежее время изменения защищает файл от сборщика, пока
+            # новая ссылка на него не сохранена в базе.
+            os.utime(self.path(name))
+            return name
+        return super().save(name, content, max_length)
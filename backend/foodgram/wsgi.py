@@ -15,3 +15,14 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'foodgram.settings')
 
 application = get_wsgi_application()
+
+# Каталоги в памяти строятся до первого запроса.
+from api.catalog import (  # noqa: E402
+    ingredient_index,
+    ingredient_snapshot,
+    recipe_ingredient_index,
+)
+
+ingredient_index.warm()
+ingredient_snapshot.warm()
+recipe_ingredient_index.warm()
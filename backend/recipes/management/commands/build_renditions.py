@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from foodgram.images import process_renditions
+from recipes.models import Recipe, User
+
+
+class Command(BaseCommand):
+    help = 'Build missing image renditions for recipes and user avatars.'
+
+    def handle(self, *args, **options):
+        built = 0
+        for model, field_name, renditions_field in (
+            (Recipe, 'image', 'image_renditions'),
+            (User, 'avatar', 'avatar_renditions'),
+        ):
+            queryset = model.objects.exclude(
+                **{field_name: ''},
+            ).values_list('pk', field_name, renditions_field)
+            for pk, name, renditions in queryset.iterator():
+                renditions = renditions or {}
+                if (
+                    renditions.get('source') == name
+                    and 'blurhash' in renditions
+                ):
+                    continue
+                process_renditions(model, pk, field_name, renditions_field)
+                built += 1
+        self.stdout.write(
+            self.style.SUCCESS(f'Renditions built for {built} images.'),
+        )
@@ -0,0 +1,95 @@
+import posixpath
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from recipes.models import Recipe, User
+
+
+IMAGE_FIELDS = (
+    (Recipe, 'image', 'image_renditions'),
+    (User, 'avatar', 'avatar_renditions'),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete media files that are not referenced by recipe images, '
+        'avatars or their renditions.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace-period',
+            type=int,
+            default=settings.MEDIA_GC_GRACE_PERIOD,
+            help='Keep unreferenced files modified within this many seconds.',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Only report the files that would be deleted.',
+        )
+
+    def handle(self, *args, **options):
+        references = self.count_references()
+        if not references:
+            raise CommandError(
+                'No media references found in the database; '
+                'refusing to delete anything.',
+            )
+        threshold = timezone.now() - timedelta(
+            seconds=options['grace_period'],
+        )
+        deleted = freed = 0
+        for name in self.list_files():
+            if references[name]:
+                continue
+            if default_storage.get_modified_time(name) > threshold:
+                continue
+            freed += default_storage.size(name)
+            deleted += 1
+            if not options['dry_run']:
+                default_storage.delete(name)
+        shared = sum(1 for count in references.values() if count > 1)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'{"Would delete" if options["dry_run"] else "Deleted"} '
+                f'{deleted} files ({freed} bytes); '
+                f'{len(references)} files in use, {shared} of them shared.',
+            ),
+        )
+
+    def count_references(self):
+        """Число ссылок из базы на каждый файл хранилища."""
+        references = Counter()
+        for model, field_name, renditions_field in IMAGE_FIELDS:
+            queryset = model.objects.exclude(
+                **{field_name: ''},
+            ).values_list(field_name, renditions_field)
+            for name, renditions in queryset.iterator():
+                references[name] += 1
+                for key in settings.IMAGE_RENDITIONS:
+                    if (renditions or {}).get(key):
+                        references[renditions[key]] += 1
+        return references
+
+    def list_files(self):
+        directories = [
+            model._meta.get_field(field_name).upload_to.rstrip('/')
+            for model, field_name, _ in IMAGE_FIELDS
+        ]
+        while directories:
+            directory = directories.pop()
+            if not default_storage.exists(directory):
+                continue
+            subdirectories, files = default_storage.listdir(directory)
+            directories.extend(
+                posixpath.join(directory, name) for name in subdirectories
+            )
+            for name in files:
+                yield posixpath.join(directory, name)
@@ -1,21 +1,214 @@
+import csv
 import json
+import re
+from itertools import islice
+from pathlib import Path
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 
-from recipes.models import Ingredient
+from api.catalog import invalidate_ingredient_catalogs
+from api.search import schedule_search_vectors
+from api.signals import touch_recipes
+from recipes.models import Ingredient, RecipeIngredient
+
+
+NAME_MAX_LENGTH = Ingredient._meta.get_field('name').max_length
+UNIT_MAX_LENGTH = Ingredient._meta.get_field('measurement_unit').max_length
+JSON_CHUNK_SIZE = 64 * 1024
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def read_json_array(file):
+    """Элементы JSON-массива из файла, который читается порциями."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+
+    def read_more():
+        nonlocal buffer, position
+        chunk = file.read(JSON_CHUNK_SIZE)
+        buffer = buffer[position:] + chunk
+        position = 0
+        return bool(chunk)
+
+    state = 'start'
+    while True:
+        position = JSON_WHITESPACE.match(buffer, position).end()
+        if position == len(buffer):
+            if not read_more():
+                raise CommandError('Unexpected end of the JSON array.')
+            continue
+        char = buffer[position]
+        if state == 'start':
+            if char != '[':
+                raise CommandError('A JSON array is expected.')
+            position += 1
+            state = 'first'
+            continue
+        if char == ']' and state in ('first', 'next'):
+            return
+        if state == 'next':
+            if char != ',':
+                raise CommandError('Invalid JSON array.')
+            position += 1
+            state = 'item'
+            continue
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            item, end = None, None
+        # Значение могло оборваться на границе порции.
+        if (end is None or end == len(buffer)) and read_more():
+            continue
+        if end is None:
+            raise CommandError('Invalid JSON array.')
+        yield item
+        position = end
+        state = 'next'
 
 
 class Command(BaseCommand):
-    help = 'Load ingredients from JSON file.'
+    help = (
+        'Load ingredients from a CSV (name,measurement_unit), JSON array '
+        'or JSON Lines file. Existing ingredients get their measurement '
+        'unit updated.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path',
+            nargs='?',
+            default='data/ingredients.csv',
+            help='Path to the data file.',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Rows per bulk upsert.',
+        )
 
     def handle(self, *args, **options):
-        with open('data/ingredients.json', 'r', encoding='utf-8') as file:
-            data = json.load(file)
-            for item in data:
-                Ingredient.objects.get_or_create(
-                    name=item['name'],
-                    measurement_unit=item['measurement_unit'],
-                )
+        path = Path(options['path'])
+        if not path.is_file():
+            raise CommandError(f'File not found: {path}')
+        self.inserted = self.updated = self.skipped = 0
+        self.updated_ids = []
+        with open(path, encoding='utf-8-sig', newline='') as file:
+            rows = self.read_rows(file)
+            with transaction.atomic():
+                while True:
+                    batch = list(islice(rows, options['batch_size']))
+                    if not batch:
+                        break
+                    self.upsert(batch)
+                self.touch_recipes(options['batch_size'])
+        if self.inserted or self.updated:
+            invalidate_ingredient_catalogs()
         self.stdout.write(
-            self.style.SUCCESS('Ingredients loaded successfully.'),
+            self.style.SUCCESS(
+                f'Ingredients loaded: inserted {self.inserted}, '
+                f'updated {self.updated}, skipped {self.skipped}.',
+            ),
         )
+
+    def read_rows(self, file):
+        """Пары (name, measurement_unit) из файла любого формата.
+
+        Формат определяется по первому значащему символу: «[» — массив
+        JSON, «{» — JSON Lines, иначе CSV.
+        """
+        head = file.read(1)
+        while head.isspace():
+            head = file.read(1)
+        file.seek(0)
+        if head == '[':
+            items = read_json_array(file)
+        elif head == '{':
+            items = self.read_json_lines(file)
+        else:
+            return (tuple(row) for row in csv.reader(file))
+        return (
+            (item.get('name'), item.get('measurement_unit'))
+            if isinstance(item, dict) else (None, None)
+            for item in items
+        )
+
+    def read_json_lines(self, file):
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                raise CommandError(f'Invalid JSON on line {number}.')
+
+    def upsert(self, batch):
+        rows = {}
+        for row in batch:
+            name, unit = (list(row) + [None, None])[:2]
+            if not isinstance(name, str) or not isinstance(unit, str):
+                self.skipped += 1
+                continue
+            name = name.strip()
+            unit = unit.strip()
+            if (
+                not name
+                or not unit
+                or len(name) > NAME_MAX_LENGTH
+                or len(unit) > UNIT_MAX_LENGTH
+                or name in rows
+            ):
+                self.skipped += 1
+                continue
+            rows[name] = unit
+        existing = dict(
+            Ingredient.objects.filter(name__in=rows).values_list(
+                'name',
+                'measurement_unit',
+            ),
+        )
+        changed = []
+        for name, unit in rows.items():
+            if name not in existing:
+                self.inserted += 1
+            elif existing[name] != unit:
+                self.updated += 1
+            else:
+                self.skipped += 1
+                continue
+            changed.append(Ingredient(name=name, measurement_unit=unit))
+        Ingredient.objects.bulk_create(
+            changed,
+            update_conflicts=True,
+            unique_fields=['name'],
+            update_fields=['measurement_unit'],
+        )
+        updated_names = [
+            name for name in rows
+            if name in existing and existing[name] != rows[name]
+        ]
+        if updated_names:
+            self.updated_ids.extend(
+                Ingredient.objects.filter(
+                    name__in=updated_names,
+                ).values_list('id', flat=True),
+            )
+
+    def touch_recipes(self, batch_size):
+        """Отмечает изменение рецептов с обновлёнными ингредиентами.
+
+        bulk_create не отправляет сигналов, поэтому кэш рецептов и их
+        updated_at обновляются здесь.
+        """
+        for start in range(0, len(self.updated_ids), batch_size):
+            recipe_ids = list(
+                RecipeIngredient.objects.filter(
+                    ingredient_id__in=self.updated_ids[
+                        start:start + batch_size
+                    ],
+                ).values_list('recipe_id', flat=True).distinct(),
+            )
+            touch_recipes(recipe_ids)
+            schedule_search_vectors(recipe_ids)
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from recipes.models import FeedEntry, User
+
+
+class Command(BaseCommand):
+    help = 'Rebuild subscription feeds from follows.'
+
+    def handle(self, *args, **options):
+        user_ids = User.objects.values_list('id', flat=True)
+        FeedEntry.objects.rebuild(user_ids)
+        self.stdout.write(self.style.SUCCESS('Feeds rebuilt successfully.'))
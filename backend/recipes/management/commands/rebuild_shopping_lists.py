@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from recipes.models import ShoppingListItem, User
+
+
+class Command(BaseCommand):
+    help = 'Rebuild aggregated shopping lists from shopping carts.'
+
+    def handle(self, *args, **options):
+        user_ids = User.objects.values_list('id', flat=True)
+        ShoppingListItem.objects.rebuild(user_ids)
+        self.stdout.write(
+            self.style.SUCCESS('Shopping lists rebuilt successfully.'),
+        )
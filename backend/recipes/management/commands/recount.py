@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from recipes.models import Favorite, Follow, Recipe, ShoppingCart, User
+
+
+def count_of(model, field):
+    """Подзапрос с числом строк model, ссылающихся на внешнюю строку."""
+    return Coalesce(
+        Subquery(
+            model.objects.filter(**{field: OuterRef('pk')})
+            .order_by()
+            .values(field)
+            .annotate(count=Count('pk'))
+            .values('count'),
+        ),
+        0,
+    )
+
+
+COUNTERS = (
+    (Recipe, 'favorites_count', Favorite, 'recipe'),
+    (Recipe, 'shopping_cart_count', ShoppingCart, 'recipe'),
+    (User, 'recipes_count', Recipe, 'author'),
+    (User, 'followers_count', Follow, 'author'),
+)
+
+
+class Command(BaseCommand):
+    help = 'Recalculate denormalized counters that drifted from the data.'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            for model, counter, related_model, field in COUNTERS:
+                actual = count_of(related_model, field)
+                fixed = (
+                    model.objects.annotate(actual=actual)
+                    .exclude(**{counter: F('actual')})
+                    .update(**{counter: actual})
+                )
+                self.stdout.write(
+                    f'{model.__name__}.{counter}: fixed {fixed} rows.',
+                )
+        self.stdout.write(self.style.SUCCESS('Counters recalculated.'))
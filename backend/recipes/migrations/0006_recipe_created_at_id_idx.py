@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('recipes', '0005_rename_description_recipe_text'),
+    ]
+    operations = [
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(
+                fields=['-created_at', '-id'],
+                name='recipe_created_at_id_idx',
+            ),
+        ),
+    ]
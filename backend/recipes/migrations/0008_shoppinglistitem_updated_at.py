@@ -0,0 +1,17 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('recipes', '0007_shoppinglistitem'),
+    ]
+    operations = [
+        migrations.AddField(
+            model_name='shoppinglistitem',
+            name='updated_at',
+            field=models.DateTimeField(
+                auto_now=True,
+                verbose_name='Дата изменения',
+            ),
+        ),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+from django.db.models import Min
+
+
+def remove_duplicate_links(apps, schema_editor):
+    RecipeShortLink = apps.get_model('recipes', 'RecipeShortLink')
+    first_ids = (
+        RecipeShortLink.objects.values('recipe_id')
+        .annotate(first_id=Min('id'))
+        .values_list('first_id', flat=True)
+    )
+    RecipeShortLink.objects.exclude(id__in=list(first_ids)).delete()
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('recipes', '0009_recipe_image_renditions'),
+    ]
+    operations = [
+        migrations.RunPython(
+            remove_duplicate_links,
+            migrations.RunPython.noop,
+        ),
+        migrations.AddConstraint(
+            model_name='recipeshortlink',
+            constraint=models.UniqueConstraint(
+                fields=['recipe'],
+                name='unique_recipe_short_link',
+            ),
+        ),
+    ]
@@ -1,10 +1,23 @@
-from django.db import models
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchVectorField
+from django.db import models, transaction
+from django.db.models.functions import RowNumber
 from django.contrib.auth import get_user_model
 from django.core.validators import MinValueValidator
+from django.utils import timezone
+
+from foodgram.cache import CacheNamespace
+from foodgram.counters import CounterFieldsMixin
 
 
 User = get_user_model()
 
+feed_cache = CacheNamespace('feed', timeout=10 * 60)
+# Поколение повышается после каждого пересчёта рейтингов рецептов.
+score_cache = CacheNamespace('recipe_scores')
+
 
 class Ingredient(models.Model):
     name = models.CharField(
@@ -27,7 +40,7 @@ class Ingredient(models.Model):
         return f'{self.name}, {self.measurement_unit}'
 
 
-class Recipe(models.Model):
+class Recipe(CounterFieldsMixin, models.Model):
     name = models.CharField(
         verbose_name='Название рецепта',
         max_length=128,
@@ -45,6 +58,12 @@ class Recipe(models.Model):
         verbose_name='Фотография блюда',
         upload_to='recipes_photo/',
     )
+    image_renditions = models.JSONField(
+        verbose_name='Уменьшенные копии фотографии',
+        default=dict,
+        blank=True,
+        editable=False,
+    )
     ingredients = models.ManyToManyField(
         Ingredient,
         verbose_name='Ингредиенты',
@@ -66,11 +85,68 @@ class Recipe(models.Model):
         auto_now_add=True,
         db_index=True,
     )
+    updated_at = models.DateTimeField(
+        verbose_name='Дата изменения',
+        auto_now=True,
+    )
+    favorites_count = models.PositiveIntegerField(
+        verbose_name='В избранном',
+        default=0,
+        editable=False,
+    )
+    shopping_cart_count = models.PositiveIntegerField(
+        verbose_name='В корзинах',
+        default=0,
+        editable=False,
+    )
+    popular_score = models.FloatField(
+        verbose_name='Рейтинг популярности',
+        default=0,
+        editable=False,
+    )
+    trending_score = models.FloatField(
+        verbose_name='Рейтинг трендов',
+        default=0,
+        editable=False,
+    )
+    # Заполняется только в PostgreSQL, там же по полю создан
+    # GIN-индекс recipe_search_vector_idx (см. миграцию 0015).
+    search_vector = SearchVectorField(
+        verbose_name='Поисковый вектор',
+        null=True,
+        editable=False,
+    )
+
+    counter_fields = ('favorites_count', 'shopping_cart_count')
+    derived_fields = (
+        'popular_score',
+        'trending_score',
+        'search_vector',
+        'image_renditions',
+    )
 
     class Meta:
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(
+                fields=['-created_at', '-id'],
+                name='recipe_created_at_id_idx',
+            ),
+            models.Index(
+                fields=['-favorites_count', '-id'],
+                name='recipe_favorites_count_idx',
+            ),
+            models.Index(
+                fields=['-popular_score', '-id'],
+                name='recipe_popular_score_idx',
+            ),
+            models.Index(
+                fields=['-trending_score', '-id'],
+                name='recipe_trending_score_idx',
+            ),
+        ]
 
     def __str__(self):
         return self.name
@@ -119,6 +195,10 @@ class ShoppingCart(models.Model):
         verbose_name='Рецепт',
         on_delete=models.CASCADE,
     )
+    created_at = models.DateTimeField(
+        verbose_name='Дата добавления',
+        auto_now_add=True,
+    )
 
     class Meta:
         verbose_name = 'Корзина покупок'
@@ -134,6 +214,156 @@ class ShoppingCart(models.Model):
         return f'{self.user} {self.recipe}'
 
 
+class ShoppingListItemManager(models.Manager):
+    """Инкрементальное обслуживание агрегированных списков покупок."""
+
+    def recipe_amounts(self, recipe):
+        """Количества ингредиентов рецепта: {ingredient_id: amount}."""
+        amounts = Counter()
+        for ingredient_id, amount in RecipeIngredient.objects.filter(
+            recipe=recipe,
+        ).values_list('ingredient_id', 'amount'):
+            amounts[ingredient_id] += amount
+        return amounts
+
+    @transaction.atomic
+    def apply(self, user_ids, deltas):
+        """Прибавляет deltas {ingredient_id: delta} к спискам user_ids.
+
+        Недостающие строки создаются, строки с неположительным
+        количеством удаляются.
+        """
+        deltas = {
+            ingredient_id: delta
+            for ingredient_id, delta in deltas.items()
+            if delta
+        }
+        if not deltas:
+            return
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+        self.bulk_create(
+            [
+                self.model(user_id=user_id, ingredient_id=ingredient_id)
+                for user_id in user_ids
+                for ingredient_id, delta in deltas.items()
+                if delta > 0
+            ],
+            ignore_conflicts=True,
+        )
+        rows = self.filter(user_id__in=user_ids, ingredient_id__in=deltas)
+        rows.update(
+            amount=models.F('amount') + models.Case(
+                *(
+                    models.When(ingredient_id=ingredient_id, then=delta)
+                    for ingredient_id, delta in deltas.items()
+                ),
+                default=0,
+            ),
+            updated_at=timezone.now(),
+        )
+        rows.filter(amount__lte=0).delete()
+
+    def version(self, user):
+        """Версия списка пользователя для HTTP-валидаторов.
+
+        Любое изменение меняет число строк, сумму количеств или
+        время последнего обновления.
+        """
+        state = self.filter(user=user).aggregate(
+            rows=models.Count('id'),
+            total=models.Sum('amount'),
+            updated_at=models.Max('updated_at'),
+        )
+        updated_at = state['updated_at']
+        return (
+            f'{state["rows"]}-{state["total"] or 0}-'
+            f'{updated_at.timestamp() if updated_at else 0}'
+        )
+
+    def add_recipe(self, user_ids, recipe):
+        self.apply(user_ids, self.recipe_amounts(recipe))
+
+    def remove_recipe(self, user_ids, recipe):
+        self.apply(
+            user_ids,
+            {
+                ingredient_id: -amount
+                for ingredient_id, amount
+                in self.recipe_amounts(recipe).items()
+            },
+        )
+
+    def update_recipe(self, recipe, deltas):
+        """Переносит изменение состава рецепта в списки его покупателей."""
+        self.apply(
+            ShoppingCart.objects.filter(recipe=recipe).values_list(
+                'user_id',
+                flat=True,
+            ),
+            deltas,
+        )
+
+    @transaction.atomic
+    def rebuild(self, user_ids):
+        """Пересчитывает списки пользователей по их корзинам."""
+        user_ids = list(user_ids)
+        self.filter(user_id__in=user_ids).delete()
+        totals = (
+            RecipeIngredient.objects.filter(
+                recipe__shoppingcart__user_id__in=user_ids,
+            )
+            .values_list('recipe__shoppingcart__user_id', 'ingredient_id')
+            .annotate(total=models.Sum('amount'))
+            .order_by()
+        )
+        self.bulk_create(
+            self.model(
+                user_id=user_id,
+                ingredient_id=ingredient_id,
+                amount=total,
+            )
+            for user_id, ingredient_id, total in totals
+        )
+
+
+class ShoppingListItem(models.Model):
+    """Строка агрегированного списка покупок пользователя."""
+
+    user = models.ForeignKey(
+        User,
+        verbose_name='Пользователь',
+        related_name='shopping_list',
+        on_delete=models.CASCADE,
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        verbose_name='Ингредиент',
+        on_delete=models.CASCADE,
+    )
+    amount = models.IntegerField(verbose_name='Количество', default=0)
+    updated_at = models.DateTimeField(
+        verbose_name='Дата изменения',
+        auto_now=True,
+    )
+
+    objects = ShoppingListItemManager()
+
+    class Meta:
+        verbose_name = 'Строка списка покупок'
+        verbose_name_plural = 'Списки покупок'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'ingredient'],
+                name='unique_user_ingredient_in_shopping_list',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.user} {self.ingredient} {self.amount}'
+
+
 class Favorite(models.Model):
     user = models.ForeignKey(
         User,
@@ -145,6 +375,10 @@ class Favorite(models.Model):
         verbose_name='Рецепты',
         on_delete=models.CASCADE,
     )
+    created_at = models.DateTimeField(
+        verbose_name='Дата добавления',
+        auto_now_add=True,
+    )
 
     class Meta:
         verbose_name = 'Избранное'
@@ -180,6 +414,12 @@ class RecipeShortLink(models.Model):
     class Meta:
         verbose_name = 'Короткая ссылка на рецепт'
         verbose_name_plural = 'Короткие ссылки на рецепты'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['recipe'],
+                name='unique_recipe_short_link',
+            ),
+        ]
 
     def __str__(self):
         return f'{self.url_hash} -> {self.recipe.name}'
@@ -215,3 +455,178 @@ class Follow(models.Model):
 
     def __str__(self):
         return f'{self.user} {self.author}'
+
+
+class FeedEntryManager(models.Manager):
+    """Ленты рецептов авторов, на которых подписан пользователь.
+
+    Новый рецепт сразу записывается в ленты подписчиков автора. Для
+    авторов, у которых подписчиков больше FEED_FANOUT_LIMIT, записи не
+    создаются: их рецепты добавляются в ленту при чтении. Лента
+    пользователя обрезается до FEED_LENGTH последних записей.
+    """
+
+    def popular_author_ids(self):
+        """Авторы, рецепты которых не раскладываются по лентам."""
+        author_ids = feed_cache.get('popular_authors')
+        if author_ids is None:
+            author_ids = set(
+                Follow.objects.values('author')
+                .annotate(followers=models.Count('id'))
+                .filter(followers__gt=settings.FEED_FANOUT_LIMIT)
+                .values_list('author', flat=True),
+            )
+            feed_cache.set('popular_authors', author_ids)
+        return author_ids
+
+    def is_popular(self, author_id):
+        return Follow.objects.filter(author_id=author_id)[
+            settings.FEED_FANOUT_LIMIT:settings.FEED_FANOUT_LIMIT + 1
+        ].exists()
+
+    def recipes_filter(self, user):
+        """Условие на Recipe для рецептов из ленты пользователя."""
+        condition = models.Q(
+            id__in=self.filter(user=user).values('recipe_id'),
+        )
+        popular_author_ids = self.popular_author_ids()
+        if popular_author_ids:
+            condition |= models.Q(
+                author_id__in=Follow.objects.filter(
+                    user=user,
+                    author_id__in=popular_author_ids,
+                ).values('author_id'),
+            )
+        return condition
+
+    @transaction.atomic
+    def fan_out(self, recipe):
+        """Записывает рецепт в ленты подписчиков автора."""
+        follower_ids = list(
+            Follow.objects.filter(author_id=recipe.author_id).values_list(
+                'user_id',
+                flat=True,
+            )[:settings.FEED_FANOUT_LIMIT + 1],
+        )
+        if len(follower_ids) > settings.FEED_FANOUT_LIMIT:
+            if recipe.author_id not in self.popular_author_ids():
+                # Автор стал популярным после расчёта множества.
+                feed_cache.delete_many(['popular_authors'])
+            return
+        self.bulk_create(
+            [
+                self.model(
+                    user_id=user_id,
+                    recipe=recipe,
+                    created_at=recipe.created_at,
+                )
+                for user_id in follower_ids
+            ],
+            ignore_conflicts=True,
+        )
+        self.trim(follower_ids)
+
+    @transaction.atomic
+    def add_author(self, user, author):
+        """Добавляет в ленту последние рецепты нового автора подписки."""
+        if self.is_popular(author.id):
+            return
+        self.bulk_create(
+            [
+                self.model(
+                    user=user,
+                    recipe_id=recipe_id,
+                    created_at=created_at,
+                )
+                for recipe_id, created_at in Recipe.objects.filter(
+                    author=author,
+                ).order_by('-created_at', '-id').values_list(
+                    'id',
+                    'created_at',
+                )[:settings.FEED_LENGTH]
+            ],
+            ignore_conflicts=True,
+        )
+        self.trim([user.id])
+
+    def remove_author(self, user, author):
+        self.filter(user=user, recipe__author=author).delete()
+
+    def trim(self, user_ids):
+        """Удаляет записи лент сверх FEED_LENGTH последних.
+
+        Окно по записям строится только для лент длиннее FEED_LENGTH.
+        """
+        user_ids = list(
+            self.filter(user_id__in=user_ids)
+            .values('user_id')
+            .annotate(entries=models.Count('id'))
+            .filter(entries__gt=settings.FEED_LENGTH)
+            .values_list('user_id', flat=True),
+        )
+        if not user_ids:
+            return
+        extra_ids = list(
+            self.filter(user_id__in=user_ids)
+            .annotate(
+                position=models.Window(
+                    RowNumber(),
+                    partition_by=models.F('user'),
+                    order_by=(
+                        models.F('created_at').desc(),
+                        models.F('recipe_id').desc(),
+                    ),
+                ),
+            )
+            .filter(position__gt=settings.FEED_LENGTH)
+            .values_list('id', flat=True),
+        )
+        if extra_ids:
+            self.filter(id__in=extra_ids).delete()
+
+    @transaction.atomic
+    def rebuild(self, user_ids):
+        """Собирает ленты пользователей заново по их подпискам."""
+        user_ids = list(user_ids)
+        self.filter(user_id__in=user_ids).delete()
+        for follow in Follow.objects.filter(
+            user_id__in=user_ids,
+        ).select_related('user', 'author'):
+            self.add_author(follow.user, follow.author)
+
+
+class FeedEntry(models.Model):
+    user = models.ForeignKey(
+        User,
+        verbose_name='Пользователь',
+        related_name='feed',
+        on_delete=models.CASCADE,
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        verbose_name='Рецепт',
+        related_name='feed_entries',
+        on_delete=models.CASCADE,
+    )
+    created_at = models.DateTimeField(verbose_name='Дата создания рецепта')
+
+    objects = FeedEntryManager()
+
+    class Meta:
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Записи лент'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'recipe'],
+                name='unique_user_recipe_in_feed',
+            ),
+        ]
+        indexes = [
+            models.Index(
+                fields=['user', '-created_at', '-recipe'],
+                name='feed_user_created_at_idx',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.user} {self.recipe}'
@@ -1,10 +1,11 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 
+from foodgram.counters import CounterFieldsMixin
 from foodgram.validators import AllowedCharactersUsernameValidator
 
 
-class User(AbstractUser):
+class User(CounterFieldsMixin, AbstractUser):
     first_name = models.CharField(verbose_name='Имя', max_length=150)
     last_name = models.CharField(verbose_name='Фамилия', max_length=150)
     email = models.EmailField(
@@ -22,6 +23,24 @@ class User(AbstractUser):
         verbose_name='Фото профиля',
         upload_to='avatar_photos/',
     )
+    avatar_renditions = models.JSONField(
+        verbose_name='Уменьшенные копии фото профиля',
+        default=dict,
+        blank=True,
+        editable=False,
+    )
+    recipes_count = models.PositiveIntegerField(
+        verbose_name='Число рецептов',
+        default=0,
+        editable=False,
+    )
+    followers_count = models.PositiveIntegerField(
+        verbose_name='Число подписчиков',
+        default=0,
+        editable=False,
+    )
+    counter_fields = ('recipes_count', 'followers_count')
+    derived_fields = ('avatar_renditions',)
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['first_name', 'last_name', 'username']
 